@@ -0,0 +1,170 @@
+import compressedfile, random, time, sys, os, json, argparse, platform
+
+#Each scenario is (name, access pattern, read or write, io size, cache state)
+#Sequential writes start from an empty file, the rest use the file left by seq-write-page
+def Scenarios(pageStep):
+	return [("seq-write-small", "seq", "write", 4096, "cold"),
+		("seq-write-page", "seq", "write", pageStep, "cold"),
+		("seq-read-small", "seq", "read", 4096, "cold"),
+		("seq-read-page", "seq", "read", pageStep, "cold"),
+		("rand-read-small", "rand", "read", 4096, "cold"),
+		("rand-read-small-warm", "rand", "read", 4096, "warm"),
+		("rand-read-page", "rand", "read", pageStep, "cold"),
+		("rand-write-small", "rand", "write", 4096, "cold"),
+		("rand-write-page", "rand", "write", pageStep, "cold")]
+
+def MakeData(kind, size, rnd):
+	#Dense data is text like, sparse data is mostly zeros with islands of text
+	words = ["".join([chr(rnd.randint(97, 122)) for j in range(rnd.randint(2, 9))]) for i in range(2000)]
+	def Text(length):
+		out = []
+		outLen = 0
+		while outLen < length:
+			word = words[rnd.randint(0, len(words)-1)] + " "
+			out.append(word)
+			outLen += len(word)
+		return "".join(out)[:length]
+
+	if kind == "dense":
+		return Text(size)
+	data = bytearray(size)
+	for i in range(size // 200000):
+		pos = rnd.randint(0, size - 20000)
+		data[pos:pos+20000] = Text(20000)
+	return str(data)
+
+def OpenFile(method, fina, create, pageStep, cacheBytes):
+	if method == "plain":
+		return open(fina, "w+b" if create else "r+b")
+	return compressedfile.CompressedFile(fina, createFile=create, method=method, pageStep=pageStep,
+		maxCacheBytes=cacheBytes)
+
+def CloseFile(fi):
+	fi.flush()
+	if isinstance(fi, file):
+		fi.close()
+
+def Offsets(pattern, size, ioSize, numOps, rnd):
+	#Sequential access covers the whole file
+	if pattern == "seq":
+		return range(0, size, ioSize)
+	return [rnd.randint(0, size - ioSize) for i in range(numOps)]
+
+def Percentile(sortedTimes, fraction):
+	if len(sortedTimes) == 0:
+		return None
+	return sortedTimes[min(int(len(sortedTimes) * fraction), len(sortedTimes) - 1)]
+
+def RunScenario(fi, scenario, data, numOps, rnd):
+	name, pattern, action, ioSize, cacheState = scenario
+	offsets = Offsets(pattern, len(data), ioSize, numOps, rnd)
+	if cacheState == "warm":
+		for pos in offsets:
+			fi.seek(pos)
+			fi.read(ioSize)
+
+	times = []
+	totalBytes = 0
+	startTime = time.time()
+	for pos in offsets:
+		opStart = time.time()
+		fi.seek(pos)
+		if action == "read":
+			expected = min(ioSize, len(data) - pos)
+			if len(fi.read(ioSize)) != expected:
+				raise RuntimeError("Short read")
+		else:
+			expected = len(data[pos:pos+ioSize])
+			fi.write(data[pos:pos+ioSize])
+		times.append(time.time() - opStart)
+		totalBytes += expected
+	if action == "write":
+		fi.flush()
+	elapsed = time.time() - startTime
+
+	times.sort()
+	return {'scenario': name, 'ops': len(offsets), 'bytes': totalBytes, 'seconds': elapsed,
+		'mbPerSec': totalBytes / 1e6 / elapsed if elapsed > 0 else None,
+		'opsPerSec': len(offsets) / elapsed if elapsed > 0 else None,
+		'p50': Percentile(times, 0.5), 'p99': Percentile(times, 0.99)}
+
+def RunMethod(method, pageStep, kind, data, args):
+	fina = "bench-{0}.dat".format(method.strip())
+	rnd = random.Random(args.seed)
+	results = []
+	fileSize = None
+	for scenario in Scenarios(pageStep):
+		#Each scenario opens the file again, so it starts with an empty cache
+		create = scenario[1] == "seq" and scenario[2] == "write"
+		if create and os.path.exists(fina):
+			os.unlink(fina)
+		fi = OpenFile(method, fina, create, pageStep, args.cache_mb * 1000000)
+		result = RunScenario(fi, scenario, data, args.ops, rnd)
+		CloseFile(fi)
+		del fi
+		if create:
+			fileSize = os.path.getsize(fina)
+		result.update({'method': method, 'pageStep': pageStep, 'data': kind})
+		results.append(result)
+
+	#Size after writing the data once, before random writes leave trash
+	for result in results:
+		result['fileBytes'] = fileSize
+		result['ratio'] = float(fileSize) / len(data)
+	os.unlink(fina)
+	return results
+
+def AddBaseline(results):
+	#Speed relative to the plain file with the same scenario, page size and data
+	baseline = {}
+	for result in results:
+		if result['method'] == "plain":
+			baseline[(result['scenario'], result['pageStep'], result['data'])] = result
+	for result in results:
+		plain = baseline.get((result['scenario'], result['pageStep'], result['data']))
+		result['vsPlain'] = None
+		if plain is not None and plain['mbPerSec'] and result['mbPerSec']:
+			result['vsPlain'] = result['mbPerSec'] / plain['mbPerSec']
+
+if __name__=="__main__":
+	parser = argparse.ArgumentParser(description="Benchmark compressed files against a plain file")
+	parser.add_argument("--methods", default="plain,null,zlib,bz2,xz,auto",
+		help="comma separated compression methods, plain is an uncompressed file")
+	parser.add_argument("--page-steps", default="100000,1000000", help="comma separated page sizes")
+	parser.add_argument("--data", default="dense,sparse", help="comma separated data kinds")
+	parser.add_argument("--size-mb", type=int, default=32, help="size of the test file")
+	parser.add_argument("--ops", type=int, default=500, help="operations per scenario")
+	parser.add_argument("--cache-mb", type=int, default=50, help="page cache size")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--json", help="write results to this file")
+	args = parser.parse_args()
+
+	methods = []
+	for method in args.methods.split(","):
+		if method not in ("plain", "auto") and not compressedfile.get_codec(method.ljust(4)).available():
+			print "Skipping unavailable method", method
+			continue
+		methods.append(method)
+
+	results = []
+	print "{0:>6} {1:>8} {2:>7} {3:>22} {4:>9} {5:>9} {6:>9} {7:>9} {8:>6} {9:>7}".format(
+		"method", "pageStep", "data", "scenario", "MB/s", "ops/s", "p50 ms", "p99 ms", "ratio", "vsPlain")
+	for kind in args.data.split(","):
+		data = MakeData(kind, args.size_mb * 1000000, random.Random(args.seed))
+		for pageStep in [int(step) for step in args.page_steps.split(",")]:
+			stepResults = []
+			for method in methods:
+				stepResults.extend(RunMethod(method, pageStep, kind, data, args))
+			AddBaseline(stepResults)
+			for result in stepResults:
+				print "{0:>6} {1:>8} {2:>7} {3:>22} {4:>9.1f} {5:>9.0f} {6:>9.3f} {7:>9.3f} {8:>6.3f} {9:>7}".format(
+					result['method'], pageStep, kind, result['scenario'], result['mbPerSec'] or 0, result['opsPerSec'] or 0,
+					result['p50'] * 1000, result['p99'] * 1000, result['ratio'],
+					"-" if result['vsPlain'] is None else "{0:.2f}".format(result['vsPlain']))
+			results.extend(stepResults)
+
+	if args.json:
+		report = {'python': platform.python_version(), 'platform': platform.platform(),
+			'seed': args.seed, 'sizeMb': args.size_mb, 'ops': args.ops, 'cacheMb': args.cache_mb,
+			'results': results}
+		json.dump(report, open(args.json, "w"), indent=1, sort_keys=True)
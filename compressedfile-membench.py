@@ -0,0 +1,62 @@
+import compressedfile, sys, os, subprocess, gc
+
+def CurrentRss():
+	#Resident memory of this process in bytes (Linux only)
+	for line in open("/proc/self/status"):
+		if line.startswith("VmRSS:"):
+			return int(line.split()[1]) * 1024
+	raise RuntimeError("Cannot determine memory usage")
+
+def BuildDictOfDicts(numPages, pageStep):
+	index = {}
+	for i in xrange(numPages):
+		uncompPos = i * pageStep
+		allocSize = 300000 + (i % 1000)
+		index[uncompPos] = {'inUse': 1, 'pagePos': 20 + i * 300053, 'compSize': allocSize - (i % 7), 'uncompPos': uncompPos,
+			'uncompSize': pageStep, 'method': "zlib", 'allocSize': allocSize}
+	return index
+
+def BuildPageTable(numPages, pageStep):
+	index = compressedfile.PageTable()
+	for i in xrange(numPages):
+		uncompPos = i * pageStep
+		allocSize = 300000 + (i % 1000)
+		index[uncompPos] = {'inUse': 1, 'pagePos': 20 + i * 300053, 'compSize': allocSize - (i % 7), 'uncompPos': uncompPos,
+			'uncompSize': pageStep, 'method': "zlib", 'allocSize': allocSize}
+	return index
+
+def MeasureChild(kind, numPages, pageStep):
+	#Run in this process, which should be freshly started
+	gc.collect()
+	before = CurrentRss()
+	if kind == "dict":
+		index = BuildDictOfDicts(numPages, pageStep)
+	else:
+		index = BuildPageTable(numPages, pageStep)
+	gc.collect()
+	after = CurrentRss()
+	if len(index) != numPages:
+		raise RuntimeError("Index has wrong length")
+	print after - before
+
+def Measure(kind, numPages, pageStep):
+	out = subprocess.check_output([sys.executable, __file__, "--child", kind, str(numPages), str(pageStep)])
+	return int(out.strip())
+
+if __name__=="__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "--child":
+		MeasureChild(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+		exit(0)
+
+	pageCounts = [1000000, 10000000]
+	if len(sys.argv) > 1:
+		pageCounts = [int(arg) for arg in sys.argv[1:]]
+	pageStep = 1000000
+
+	print "{0:>10} {1:>16} {2:>16} {3:>10} {4:>10}".format("pages", "dict bytes", "table bytes", "dict/page", "table/page")
+	for numPages in pageCounts:
+		dictBytes = Measure("dict", numPages, pageStep)
+		tableBytes = Measure("table", numPages, pageStep)
+		print "{0:>10} {1:>16} {2:>16} {3:>10.1f} {4:>10.1f}".format(numPages, dictBytes, tableBytes,
+			float(dictBytes) / numPages, float(tableBytes) / numPages)
+
@@ -1,4 +1,546 @@
-import struct, os, copy, time, random
+import struct, os, sys, errno, time, random, zlib, array, bisect, heapq, collections, threading, Queue, mmap, weakref, hashlib
+
+def _uint64_typecode():
+	#Python 2 has no 'Q' array type but unsigned long is 64 bit on most platforms
+	for code in ("Q", "L"):
+		try:
+			if array.array(code).itemsize >= 8:
+				return code
+		except ValueError:
+			pass
+	return "d"
+
+class Codec(object):
+
+	"""
+	Compression method for page data, identified by a four character tag
+	that is stored with each page
+	"""
+
+	def __init__(self, method, defaultLevel = None):
+		self.method = method
+		self.defaultLevel = defaultLevel
+
+	def available(self):
+		return True
+
+	def compress(self, plain, level = None):
+		raise NotImplementedError()
+
+	def decompress(self, binData):
+		raise NotImplementedError()
+
+class NullCodec(Codec):
+	def compress(self, plain, level = None):
+		return str(plain)
+
+	def decompress(self, binData):
+		return binData
+
+class ZlibCodec(Codec):
+	def compress(self, plain, level = None):
+		if level is None:
+			level = self.defaultLevel
+		return zlib.compress(str(plain), level)
+
+	def decompress(self, binData):
+		return zlib.decompress(binData)
+
+class Bz2Codec(Codec):
+
+	def __init__(self, method, defaultLevel = None):
+		Codec.__init__(self, method, defaultLevel)
+		self.module = None
+		try:
+			import bz2
+			self.module = bz2
+		except ImportError:
+			pass
+
+	def available(self):
+		return self.module is not None
+
+	def compress(self, plain, level = None):
+		if self.module is None:
+			raise RuntimeError("bz2 module is not available")
+		if level is None:
+			level = self.defaultLevel
+		return self.module.compress(str(plain), level)
+
+	def decompress(self, binData):
+		if self.module is None:
+			raise RuntimeError("bz2 module is not available")
+		return self.module.decompress(binData)
+
+class LzmaCodec(Codec):
+
+	def __init__(self, method, defaultLevel = None):
+		Codec.__init__(self, method, defaultLevel)
+		self.module = None
+		try:
+			import lzma
+			self.module = lzma
+		except ImportError:
+			try:
+				from backports import lzma
+				self.module = lzma
+			except ImportError:
+				pass
+
+	def available(self):
+		return self.module is not None
+
+	def compress(self, plain, level = None):
+		if self.module is None:
+			raise RuntimeError("lzma module is not available")
+		if level is None:
+			level = self.defaultLevel
+		return self.module.compress(str(plain), preset=level)
+
+	def decompress(self, binData):
+		if self.module is None:
+			raise RuntimeError("lzma module is not available")
+		return self.module.decompress(binData)
+
+class ZlibDictCodec(Codec):
+
+	"""
+	zlib with a preset dictionary that is shared by every page in a file
+	Python 2 zlib has no zdict option, so a compressor and decompressor are
+	primed with the dictionary once and copied for each page
+	"""
+
+	def __init__(self, method, dictionary, defaultLevel = 6):
+		Codec.__init__(self, method, defaultLevel)
+		self.dictionary = dictionary
+		self._compressors = {}
+
+		decompressor = zlib.decompressobj()
+		decompressor.decompress(self._primed_compressor(defaultLevel)[1])
+		self._decompressor = decompressor
+
+	def _primed_compressor(self, level):
+		compressor = zlib.compressobj(level)
+		prefix = compressor.compress(self.dictionary) + compressor.flush(zlib.Z_SYNC_FLUSH)
+		return compressor, prefix
+
+	def compress(self, plain, level = None):
+		if level is None:
+			level = self.defaultLevel
+		if level not in self._compressors:
+			self._compressors[level] = self._primed_compressor(level)[0]
+		compressor = self._compressors[level].copy()
+		return compressor.compress(str(plain)) + compressor.flush()
+
+	def decompress(self, binData):
+		decompressor = self._decompressor.copy()
+		return decompressor.decompress(binData) + decompressor.flush()
+
+def train_dictionary(samples, size = 32768, segmentLen = 8, chunkLen = 256):
+	"""
+	Build a preset dictionary from sample pages. Short segments are counted
+	by how many samples contain them, then chunks of the samples are chosen
+	greedily by how many common segments they add that are not already in
+	the dictionary. The best chunks go last, where zlib reaches them with
+	the shortest distances.
+	"""
+
+	counts = collections.defaultdict(int)
+	for sample in samples:
+		sample = str(sample)
+		for segment in set(sample[i:i+segmentLen] for i in xrange(len(sample) - segmentLen + 1)):
+			#Runs of one byte, such as padding, compress well without a dictionary
+			if segment.count(segment[0]) == len(segment):
+				continue
+			counts[segment] += 1
+
+	def score(chunk):
+		return sum(max(counts[chunk[i:i+segmentLen]] - 1, 0) for i in xrange(len(chunk) - segmentLen + 1))
+
+	heap = []
+	for sample in samples:
+		sample = str(sample)
+		for i in xrange(0, len(sample) - chunkLen + 1, chunkLen):
+			chunk = sample[i:i+chunkLen]
+			heap.append((-score(chunk), chunk))
+	heapq.heapify(heap)
+
+	#Scores only fall as chunks are chosen, so they are recalculated lazily
+	chosen = []
+	total = 0
+	while total < size and len(heap) > 0:
+		negScore, chunk = heapq.heappop(heap)
+		current = score(chunk)
+		if current <= 0:
+			#Spent, for example a copy of a chunk already chosen
+			continue
+		if len(heap) > 0 and current < -heap[0][0]:
+			heapq.heappush(heap, (-current, chunk))
+			continue
+		for i in xrange(len(chunk) - segmentLen + 1):
+			counts[chunk[i:i+segmentLen]] = 0
+		chosen.append(chunk)
+		total += len(chunk)
+
+	chosen.reverse()
+	return "".join(chosen)[-size:]
+
+#Codecs by method tag
+codecs = {}
+
+def register_codec(codec):
+	if len(codec.method) != 4:
+		raise ValueError("Method tag must be four characters")
+	codecs[codec.method] = codec
+
+register_codec(NullCodec("null"))
+register_codec(ZlibCodec("zlib", 6))
+register_codec(Bz2Codec("bz2 ", 9))
+register_codec(LzmaCodec("xz  ", 6))
+
+def get_codec(method):
+	if method not in codecs:
+		raise Exception("Not implemented compression: '" + method + "'")
+	return codecs[method]
+
+class FileStats(object):
+
+	"""
+	Counters, codec totals and latency histograms for a compressed file
+	Recording is a dictionary update, so stats may be left on. Latencies are
+	counted in power of two buckets of microseconds. Current values, such
+	as the size of the trash, are passed in as gauges when a snapshot is taken.
+	"""
+
+	latencyBuckets = 32
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.counters = collections.defaultdict(int)
+			self.codecs = {}
+			self.latency = {}
+
+	def count(self, name, value = 1):
+		self.counters[name] += value
+
+	def record_codec(self, method, action, bytesIn, bytesOut, seconds):
+		#Codecs run in worker threads, so this takes the lock
+		with self._lock:
+			totals = self.codecs.setdefault((method, action), [0, 0, 0, 0.0])
+			totals[0] += 1
+			totals[1] += bytesIn
+			totals[2] += bytesOut
+			totals[3] += seconds
+
+	def record_latency(self, op, seconds):
+		bucket = min(int(seconds * 1000000).bit_length(), self.latencyBuckets - 1)
+		histogram = self.latency.get(op)
+		if histogram is None:
+			histogram = self.latency[op] = [0] * self.latencyBuckets
+		histogram[bucket] += 1
+
+	def _percentile(self, histogram, total, fraction):
+		#Upper bound in seconds of the bucket holding the given fraction of samples
+		seen = 0
+		for bucket, count in enumerate(histogram):
+			seen += count
+			if seen >= total * fraction:
+				return (1 << bucket) / 1000000.0
+		return None
+
+	def snapshot(self, gauges = None):
+		"""
+		Return a copy of the stats as plain dicts and lists
+		"""
+		with self._lock:
+			codecs = {}
+			for (method, action), totals in self.codecs.iteritems():
+				codecs.setdefault(method.strip(), {})[action] = {'pages': totals[0],
+					'bytesIn': totals[1], 'bytesOut': totals[2], 'seconds': totals[3]}
+		counters = dict(self.counters)
+
+		latency = {}
+		for op, histogram in self.latency.items():
+			total = sum(histogram)
+			latency[op] = {'count': total,
+				'buckets': [((1 << bucket) / 1000000.0, count) for bucket, count in enumerate(histogram) if count],
+				'p50': self._percentile(histogram, total, 0.5),
+				'p99': self._percentile(histogram, total, 0.99)}
+
+		if gauges is None:
+			gauges = {}
+
+		hits = counters.get('cacheReads', 0)
+		misses = counters.get('diskReads', 0)
+		hitRatio = None
+		if hits + misses > 0:
+			hitRatio = float(hits) / (hits + misses)
+
+		return {'counters': counters, 'codecs': codecs, 'latency': latency,
+			'gauges': gauges, 'pageCacheHitRatio': hitRatio,
+			'pagesCompressed': sum([action['compress']['pages'] for action in codecs.values() if 'compress' in action]),
+			'pagesDecompressed': sum([action['decompress']['pages'] for action in codecs.values() if 'decompress' in action])}
+
+def _stat_property(name):
+	#Counter attribute stored in the stats object, so it is cleared by reset
+	return property(lambda self: self.stats.counters[name],
+		lambda self, value: self.stats.counters.__setitem__(name, value))
+
+class PageTable(object):
+
+	"""
+	Compact index of on disk pages, keyed by uncompressed position
+	Page metadata is stored in parallel arrays rather than a dict per page
+	Lookups return a new meta dict, so changes must be stored back
+	"""
+
+	def __init__(self):
+		typecode = _uint64_typecode()
+		self.rows = {}
+		self.uncompPos = array.array(typecode)
+		self.pagePos = array.array(typecode)
+		self.uncompSize = array.array(typecode)
+		self.compSize = array.array(typecode)
+		self.allocSize = array.array(typecode)
+		self.method = array.array("B")
+		self.methodNames = []
+		self.methodIds = {}
+		self._sortedKeys = None
+
+	def _method_id(self, method):
+		if method not in self.methodIds:
+			if len(self.methodNames) >= 256:
+				raise RuntimeError("Too many compression methods")
+			self.methodIds[method] = len(self.methodNames)
+			self.methodNames.append(method)
+		return self.methodIds[method]
+
+	def get(self, uncompPos, default = None):
+		row = self.rows.get(uncompPos)
+		if row is None:
+			return default
+		return {'inUse': 1, 'pagePos': int(self.pagePos[row]), 'compSize': int(self.compSize[row]),
+			'uncompPos': int(self.uncompPos[row]), 'uncompSize': int(self.uncompSize[row]),
+			'method': self.methodNames[self.method[row]], 'allocSize': int(self.allocSize[row])}
+
+	def __getitem__(self, uncompPos):
+		meta = self.get(uncompPos)
+		if meta is None:
+			raise KeyError(uncompPos)
+		return meta
+
+	def __setitem__(self, uncompPos, meta):
+		methodId = self._method_id(meta['method'])
+		row = self.rows.get(uncompPos)
+		if row is None:
+			self._sortedKeys = None
+			self.rows[uncompPos] = len(self.uncompPos)
+			self.uncompPos.append(uncompPos)
+			self.pagePos.append(meta['pagePos'])
+			self.uncompSize.append(meta['uncompSize'])
+			self.compSize.append(meta['compSize'])
+			self.allocSize.append(meta['allocSize'])
+			self.method.append(methodId)
+			return
+
+		self.pagePos[row] = meta['pagePos']
+		self.uncompSize[row] = meta['uncompSize']
+		self.compSize[row] = meta['compSize']
+		self.allocSize[row] = meta['allocSize']
+		self.method[row] = methodId
+
+	def __delitem__(self, uncompPos):
+		#Move the last row into the gap to keep the arrays dense
+		row = self.rows.pop(uncompPos)
+		self._sortedKeys = None
+		last = len(self.uncompPos) - 1
+		if row != last:
+			for column in (self.uncompPos, self.pagePos, self.uncompSize, self.compSize, self.allocSize, self.method):
+				column[row] = column[last]
+			self.rows[int(self.uncompPos[row])] = row
+		for column in (self.uncompPos, self.pagePos, self.uncompSize, self.compSize, self.allocSize, self.method):
+			column.pop()
+
+	def __contains__(self, uncompPos):
+		return uncompPos in self.rows
+
+	def __len__(self):
+		return len(self.rows)
+
+	def __iter__(self):
+		return iter(self.rows)
+
+	def keys(self):
+		return self.rows.keys()
+
+	def sorted_keys(self):
+		#Cached until a page is added or removed
+		if self._sortedKeys is None:
+			self._sortedKeys = sorted(self.rows)
+		return self._sortedKeys
+
+
+class FreeExtents(object):
+
+	"""
+	Free space in the file that can be reused for pages
+	Extents are kept sorted by size so a best fit is found by bisection
+	Adjacent extents are merged into one larger extent
+	"""
+
+	def __init__(self, recordOverhead):
+		#Bytes used by the header and footer of each record
+		self.recordOverhead = recordOverhead
+		self.bySize = []
+		self.byPos = {}
+		self.byEnd = {}
+
+	def _end(self, pagePos, allocSize):
+		return pagePos + self.recordOverhead + allocSize
+
+	def _insert(self, pagePos, allocSize):
+		bisect.insort(self.bySize, (allocSize, pagePos))
+		self.byPos[pagePos] = allocSize
+		self.byEnd[self._end(pagePos, allocSize)] = pagePos
+
+	def remove(self, pagePos):
+		allocSize = self.byPos.pop(pagePos)
+		del self.byEnd[self._end(pagePos, allocSize)]
+		i = bisect.bisect_left(self.bySize, (allocSize, pagePos))
+		del self.bySize[i]
+		return allocSize
+
+	def add(self, pagePos, allocSize):
+		"""
+		Add free space, merged with free space immediately before or after.
+		Returns (pagePos, allocSize, prevSize, nextSize) where prevSize and
+		nextSize are the sizes of the extents merged in, or None.
+		"""
+
+		prevSize = None
+		nextSize = None
+		if pagePos in self.byEnd:
+			prevPos = self.byEnd[pagePos]
+			prevSize = self.remove(prevPos)
+			allocSize += prevSize + self.recordOverhead
+			pagePos = prevPos
+		nextPos = self._end(pagePos, allocSize)
+		if nextPos in self.byPos:
+			nextSize = self.remove(nextPos)
+			allocSize += nextSize + self.recordOverhead
+
+		self._insert(pagePos, allocSize)
+		return pagePos, allocSize, prevSize, nextSize
+
+	def allocate(self, size, useThreshold):
+		"""
+		Find space for size bytes of data. Returns (pagePos, allocSize, remainder)
+		where remainder is a left over (pagePos, allocSize) extent, or None if
+		there is no suitable free space.
+		"""
+
+		#Smallest extent that fits, if it does not waste too much space
+		i = bisect.bisect_left(self.bySize, (size, -1))
+		if i < len(self.bySize):
+			allocSize, pagePos = self.bySize[i]
+			if allocSize * useThreshold <= size:
+				self.remove(pagePos)
+				return pagePos, allocSize, None
+
+		#Otherwise split the smallest extent that can hold the data and another record
+		i = bisect.bisect_left(self.bySize, (size + self.recordOverhead, -1))
+		if i < len(self.bySize):
+			allocSize, pagePos = self.bySize[i]
+			self.remove(pagePos)
+			remainder = (pagePos + self.recordOverhead + size, allocSize - size - self.recordOverhead)
+			self._insert(*remainder)
+			return pagePos, size, remainder
+
+		return None
+
+	def __len__(self):
+		return len(self.byPos)
+
+	def __iter__(self):
+		for allocSize, pagePos in self.bySize:
+			yield pagePos, allocSize
+
+	def total_size(self):
+		return sum(self.byPos.itervalues())
+
+def _merge_extents(pageStarts, pageStep, length):
+	#Join sorted page starts into (start, length) extents, clipped to the file length
+	extentStart = None
+	extentEnd = None
+	for uncompPos in pageStarts:
+		if uncompPos >= length:
+			break
+		if extentEnd is not None and uncompPos == extentEnd:
+			extentEnd += pageStep
+			continue
+		if extentStart is not None:
+			yield extentStart, min(extentEnd, length) - extentStart
+		extentStart = uncompPos
+		extentEnd = uncompPos + pageStep
+	if extentStart is not None:
+		yield extentStart, min(extentEnd, length) - extentStart
+
+def _seek_data(fi, pos, pageStep):
+	if pos < 0 or pos >= len(fi):
+		raise IOError(errno.ENXIO, "No data after position")
+	pageStart = pos - (pos % pageStep)
+	if fi._has_page(pageStart):
+		return pos
+	nextStart = fi._next_data_page(pageStart)
+	if nextStart is None or nextStart >= len(fi):
+		raise IOError(errno.ENXIO, "No data after position")
+	return nextStart
+
+def _seek_hole(fi, pos, pageStep):
+	if pos < 0 or pos >= len(fi):
+		raise IOError(errno.ENXIO, "Position is past the end of the file")
+	pageStart = pos - (pos % pageStep)
+	while pageStart < len(fi) and fi._has_page(pageStart):
+		pageStart += pageStep
+	#The end of the file counts as a hole
+	return min(max(pageStart, pos), len(fi))
+
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+def _load_fallocate():
+	#Hole punching needs fallocate from the C library, which is Linux only
+	try:
+		import ctypes, ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		fallocate = libc.fallocate
+	except (ImportError, OSError, AttributeError):
+		return None
+	fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+	fallocate.restype = ctypes.c_int
+	return fallocate
+
+_fallocate = _load_fallocate()
+
+def punch_hole(fi, offset, length):
+	"""
+	Release the disk space of a range of an open file, which then reads as
+	zeros. Returns False if the file system or platform does not support it.
+	"""
+	if _fallocate is None or not hasattr(fi, "fileno"):
+		return False
+	fi.flush()
+	return _fallocate(fi.fileno(), FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+def _next_page_start(sortedStarts, pos):
+	i = bisect.bisect_left(sortedStarts, pos)
+	if i < len(sortedStarts):
+		return sortedStarts[i]
+	return None
 
 class CompressedFileLowLevel(object):
 
@@ -8,20 +550,28 @@ class CompressedFileLowLevel(object):
 	Seeking is supported
 	Changes are immediately written to disk
 	Storage is sparse, so empty areas are not stored at all
+	A page directory is written on flush so opening does not scan every page
 	Functionality is extended by CompressedFile
 	"""
 
-	def __init__(self, fi, readOnly = False, createFile = False, method = "zlib"):
+	compressedCacheHits = _stat_property('compressedCacheHits')
+	compressedCacheMisses = _stat_property('compressedCacheMisses')
+
+	def __init__(self, fi, readOnly = False, createFile = False, method = "zlib", level = None, pageStep = 1000000,
+		useMmap = False):
 
 		if not os.path.isfile(fi) and not createFile:
 			raise IOError("File not found")
 
 		self.readOnly = readOnly
 		self.debugMode = False
+		self.stats = FileStats()
 
 		#Pad method to four characters
 		while len(method) < 4:
 			method = method + " "
+		if method in codecs and not codecs[method].available():
+			raise RuntimeError("Compression method '" + method + "' is not available")
 
 		if isinstance(fi, str):
 			if not createFile:
@@ -45,24 +595,93 @@ class CompressedFileLowLevel(object):
 
 		#self.method = "bz2 "
 		self.method = method
+		self.level = level
+
+		#Codecs tried per page in auto mode, stopping when autoTimeBudget seconds are used
+		self.autoMethods = ["zlib", "zdct", "bz2 ", "xz  "]
+		self.autoTimeBudget = 0.1
+		self.autoMinRatio = 0.97
 		self.virtualCursor = 0
-		self.pageStep = 1000000
+		self.pageStep = pageStep
 		self.useTrashThreshold = 0.9
-		self.emptyPage = bytearray("".join("\x00" for i in range(self.pageStep)))
+		#Free space of at least punchHoleBytes is given back to the file system.
+		#None turns this off. Where holes cannot be punched, the space is zero
+		#filled if zeroFillHoles is set, which only helps file systems that
+		#compress or detect zeros.
+		self.punchHoleBytes = 1000000
+		self.zeroFillHoles = False
+		self.punchAlign = 4096
+		self._canPunch = True
+		#Moved pages go to the end of the file rather than into the trash, so streamed pages stay in order
+		self.placeAtEnd = False
+		self.zeroPage = "\x00" * self.pageStep
+
+		#inUse, uncompSize, compSize, uncompPos, allocSize
+		self.headerStruct = struct.Struct(">BQQQQ")
+
+		self.footerStruct = struct.Struct(">Q")
+		self.plainLen = 0
+
+		#Bytes used by a page record in addition to its allocated space
+		self.recordOverhead = 4 + self.headerStruct.size + 4 + self.footerStruct.size + 4
 
 		#Index of on disk pages
-		self.pageIndex = {}
-		self.pageTrash = []
+		self.pageIndex = PageTable()
+		self.pageTrash = FreeExtents(self.recordOverhead)
 
 		#Temporary cache of decompressed pages
 		self._pageCache = []
 		self._metaCache = []
 
-		#inUse, uncompSize, compSize, uncompPos, allocSize
-		self.headerStruct = struct.Struct(">BQQQQ")
-
-		self.footerStruct = struct.Struct(">Q")
-		self.plainLen = 0
+		#Optional cache of compressed page data, ordered from least to most recently used
+		self.maxCompressedCacheBytes = 0
+		self.compressedCache = collections.OrderedDict()
+		self.compressedCacheBytes = 0
+		self.compressedCacheHits = 0
+		self.compressedCacheMisses = 0
+
+		#Optional memory map of the file, used to read null pages without copying
+		self.useMmap = useMmap
+		self._mmap = None
+		self.mmapRemaps = 0
+
+		#Serialises positional reads where the os has no pread
+		self._ioLock = threading.Lock()
+
+		#Page directory: plainLen, pageStep, dirPos, numPages, numTrash, dictPos
+		self.dirHeaderStruct = struct.Struct(">QQQQQQ")
+		#uncompPos, pagePos, uncompSize, compSize, allocSize, method
+		self.dirPageStruct = struct.Struct(">QQQQQ4s")
+		#pagePos, allocSize
+		self.dirTrashStruct = struct.Struct(">QQ")
+		#uncompPos, content hash of the record the page owns
+		self.dirHashStruct = struct.Struct(">Q32s")
+		self._dirMeta = None
+		self._dirValid = False
+		self._dirPlainLen = None
+
+		#Overlay of small writes, kept as delta records instead of rewriting the page.
+		#Writes of up to smallWriteBytes use it, 0 turns it off. A page is rewritten
+		#once its delta records would take more than maxOverlayBytes, by default
+		#a sixteenth of a page.
+		self.smallWriteBytes = 0
+		self.maxOverlayBytes = None
+		#seq, offset
+		self.deltaStruct = struct.Struct(">QQ")
+		self._init_overlay()
+
+		#With dedup, a page identical to one already stored shares its record.
+		#The record belongs to one page and reference records list the others.
+		#Pages are indexed by content hash as they are written, and the hashes
+		#are kept in the page directory for later sessions.
+		self.dedup = False
+		#uncompPos, pagePos of the shared record
+		self.refStruct = struct.Struct(">QQ")
+		self._init_references()
+
+		#Codecs that depend on data stored in this file, such as a preset dictionary
+		self.fileCodecs = {}
+		self._dictMeta = None
 
 		if createFile:
 			if self.readOnly:
@@ -88,18 +707,28 @@ class CompressedFileLowLevel(object):
 	def flush(self):
 		if self.readOnly:
 			return
+		if self._dirValid and self._dirPlainLen != self.plainLen:
+			self._invalidate_page_directory()
+		if not self._dirValid:
+			self._write_page_directory()
 		self.handle.seek(4)
 		self.handle.write(struct.pack(">QQ", self.plainLen, self.pageStep))
+		self.handle.flush()
 
-	def _write_fresh_page(self, data, disableLengthUpdate = 0):
-		#Create a fresh page to contain data
+	def _new_page_meta(self, uncompPos):
+		#Meta data for a page that is not yet on disk
 		meta = {}
 		meta['pagePos'] = None
 		meta['compSize'] = None
-		meta['uncompPos'] = self.virtualCursor - (self.virtualCursor % self.pageStep)
+		meta['uncompPos'] = uncompPos
 	 	meta['uncompSize'] = self.pageStep
 		meta['method'] = self.method
 		meta['allocSize'] = None
+		return meta
+
+	def _write_fresh_page(self, data, disableLengthUpdate = 0):
+		#Create a fresh page to contain data
+		meta = self._new_page_meta(self.virtualCursor - (self.virtualCursor % self.pageStep))
 			
 		pageCursor = self.virtualCursor - meta['uncompPos']
 		bytesRemainingInPage = meta['uncompSize'] - pageCursor
@@ -107,12 +736,13 @@ class CompressedFileLowLevel(object):
 		if bytes > bytesRemainingInPage:
 			bytes = bytesRemainingInPage
 
-		plain = copy.deepcopy(self.emptyPage)
-		plain[pageCursor:pageCursor+bytes] = data[:bytes]
+		#Pages of zeros are not stored
+		if not self._is_zero(data[:bytes]):
+			plain = bytearray(self.pageStep)
+			plain[pageCursor:pageCursor+bytes] = data[:bytes]
+			self._write_page_to_disk(meta, plain)
 		data = data[bytes:]
 		self.virtualCursor += bytes
-				
-		self._write_page_to_disk(meta, plain)
 
 		if self.virtualCursor > self.plainLen and not disableLengthUpdate:
 			self.plainLen = self.virtualCursor 
@@ -121,12 +751,21 @@ class CompressedFileLowLevel(object):
 
 	def _write_existing_page(self, data, meta, disableLengthUpdate = 0):
 		#Check if entire page written
-		entire = self.virtualCursor == meta['uncompPos'] and len(data) > meta['uncompSize']
+		entire = self.virtualCursor == meta['uncompPos'] and len(data) >= meta['uncompSize']
+
+		pageCursor = self.virtualCursor - meta['uncompPos']
+		bytes = min(len(data), meta['uncompSize'] - pageCursor)
 
 		if entire:
 			plain = data[:meta['uncompSize']]
 			data = data[meta['uncompSize']:]
 			self.virtualCursor += meta['uncompSize']
+		elif self._use_overlay(meta, bytes):
+			self._write_delta(data[:bytes], meta)
+			self.virtualCursor += bytes
+			if self.virtualCursor > self.plainLen and not disableLengthUpdate:
+				self.plainLen = self.virtualCursor
+			return data[bytes:]
 		else:
 			plain = bytearray(self._read_entire_page(meta))
 			pageCursor = self.virtualCursor - meta['uncompPos']
@@ -169,9 +808,27 @@ class CompressedFileLowLevel(object):
 
 		self.plainLen = struct.unpack(">Q", self.handle.read(8))[0]
 		self.pageStep = struct.unpack(">Q", self.handle.read(8))[0]
-		self.emptyPage = bytearray("".join("\x00" for i in range(self.pageStep)))
-		self.pageIndex = {}
-		self.pageTrash = []
+		self.zeroPage = "\x00" * self.pageStep
+		self.pageIndex = PageTable()
+		self.pageTrash = FreeExtents(self.recordOverhead)
+		self._dirMeta = None
+		self._dirValid = False
+		self.fileCodecs = {}
+		self._dictMeta = None
+		self._init_overlay()
+		self._init_references()
+
+		#Use the page directory if it is up to date, otherwise scan every page
+		if self._read_page_directory():
+			self._build_references()
+			self._build_overlay()
+			return
+
+		self.pageIndex = PageTable()
+		self.pageTrash = FreeExtents(self.recordOverhead)
+		self._init_overlay()
+		self._init_references()
+		self.handle.seek(20)
 		while True:
 			meta = self._parse_header_at_cursor()
 			if meta is None:
@@ -179,13 +836,668 @@ class CompressedFileLowLevel(object):
 			#print "meta", meta
 			if meta['inUse']:
 				self.pageIndex[meta['uncompPos']] = meta
+			elif meta['method'] == "dict":
+				self._load_dictionary(meta)
+			elif meta['method'] == "dlta":
+				self._load_delta(meta)
+			elif meta['method'] == "dref":
+				self._load_reference(meta)
 			else:
-				self.pageTrash.append(meta)
-			self.handle.seek(meta['allocSize'], 1)
+				#Stale directories are treated as free space
+				self.pageTrash.add(meta['pagePos'], meta['allocSize'])
+			self.handle.seek(meta['pagePos'] + 8 + self.headerStruct.size + meta['allocSize'])
 			footerData = self.handle.read(8)
 			endStr = self.handle.read(4)
 			if endStr != "pend":
 				raise Exception("File format not recognised")
+		self._build_references()
+		self._build_overlay()
+
+	def _read_page_directory(self):
+		#The directory is only valid if it is the last record in the file
+		self.handle.seek(0, 2)
+		fileLen = self.handle.tell()
+		self.handle.seek(fileLen - self.footerStruct.size - 4)
+		footerData = self.handle.read(self.footerStruct.size)
+		if self.handle.read(4) != "pend":
+			return False
+		allocSize = self.footerStruct.unpack(footerData)[0]
+		dirPos = fileLen - self.footerStruct.size - 4 - allocSize - self.headerStruct.size - 8
+		if dirPos < 20:
+			return False
+
+		self.handle.seek(dirPos)
+		if self.handle.read(4) != "page":
+			return False
+		self.handle.seek(dirPos)
+		dirMeta = self._parse_header_at_cursor()
+		if dirMeta['inUse'] or dirMeta['method'] != "pdir" or dirMeta['allocSize'] != allocSize:
+			return False
+		payload = self.handle.read(dirMeta['compSize'])
+		if len(payload) != dirMeta['compSize'] or len(payload) < self.dirHeaderStruct.size + 4:
+			return False
+		if zlib.crc32(payload[:-4]) & 0xffffffff != struct.unpack(">I", payload[-4:])[0]:
+			return False
+
+		plainLen, pageStep, storedPos, numPages, numTrash, dictPos = self.dirHeaderStruct.unpack(payload[:self.dirHeaderStruct.size])
+		if plainLen != self.plainLen or pageStep != self.pageStep or storedPos != dirPos:
+			return False
+		expectedLen = self.dirHeaderStruct.size + numPages * self.dirPageStruct.size + numTrash * self.dirTrashStruct.size + 4
+		if len(payload) < expectedLen:
+			return False
+
+		#Content hashes come last, ending with "hash" and their count, which
+		#leaves the remaining length not a multiple of the entry size
+		hashEnd = len(payload) - 4
+		if (len(payload) - expectedLen) % self.dirTrashStruct.size != 0:
+			if len(payload) - expectedLen < 12 or payload[-16:-12] != "hash":
+				return False
+			numHashes = struct.unpack(">Q", payload[-12:-4])[0]
+			hashEnd = len(payload) - 16
+			hashStart = hashEnd - numHashes * self.dirHashStruct.size
+			if hashStart < expectedLen - 4:
+				return False
+			for cursor in range(hashStart, hashEnd, self.dirHashStruct.size):
+				self._loadedHashes.append(self.dirHashStruct.unpack_from(payload, cursor))
+			hashEnd = hashStart
+
+		#Any remaining entries are the positions of delta and reference records
+		if (hashEnd + 4 - expectedLen) % self.dirTrashStruct.size != 0:
+			return False
+		numDeltas = (hashEnd + 4 - expectedLen) // self.dirTrashStruct.size
+
+		cursor = self.dirHeaderStruct.size
+		for i in range(numPages):
+			uncompPos, pagePos, uncompSize, compSize, allocSize, method = self.dirPageStruct.unpack_from(payload, cursor)
+			cursor += self.dirPageStruct.size
+			self.pageIndex[uncompPos] = {'inUse': 1, 'pagePos': pagePos, 'compSize': compSize, 'uncompPos': uncompPos,
+				'uncompSize': uncompSize, 'method': method, 'allocSize': allocSize}
+		for i in range(numTrash):
+			pagePos, allocSize = self.dirTrashStruct.unpack_from(payload, cursor)
+			cursor += self.dirTrashStruct.size
+			self.pageTrash.add(pagePos, allocSize)
+		for i in range(numDeltas):
+			pagePos, allocSize = self.dirTrashStruct.unpack_from(payload, cursor)
+			cursor += self.dirTrashStruct.size
+			self.handle.seek(pagePos)
+			if self.handle.read(4) != "page":
+				return False
+			self.handle.seek(pagePos)
+			deltaMeta = self._parse_header_at_cursor()
+			if deltaMeta['inUse']:
+				return False
+			if deltaMeta['method'] == "dlta":
+				self._load_delta(deltaMeta)
+			elif deltaMeta['method'] == "dref":
+				self._load_reference(deltaMeta)
+			else:
+				return False
+
+		if dictPos:
+			self.handle.seek(dictPos)
+			if self.handle.read(4) != "page":
+				return False
+			self.handle.seek(dictPos)
+			dictMeta = self._parse_header_at_cursor()
+			if dictMeta['inUse'] or dictMeta['method'] != "dict":
+				return False
+			self._load_dictionary(dictMeta)
+
+		self._dirMeta = dirMeta
+		self._dirValid = True
+		self._dirPlainLen = plainLen
+		return True
+
+	def _invalidate_page_directory(self):
+		#Mark the on disk directory as free before the page layout changes
+		if not self._dirValid:
+			return
+		self._write_free_record(self._dirMeta['pagePos'], self._dirMeta['allocSize'])
+		self._dirValid = False
+
+	def _write_page_directory(self):
+
+		self.handle.seek(0, 2)
+		fileLen = self.handle.tell()
+
+		#Reuse the old directory location if it is still at the end of the file
+		dirPos = fileLen
+		if self._dirMeta is not None:
+			oldEnd = self._dirMeta['pagePos'] + self.headerStruct.size + 8 + self._dirMeta['allocSize'] + self.footerStruct.size + 4
+			if oldEnd == fileLen:
+				dirPos = self._dirMeta['pagePos']
+			else:
+				self._free_extent(self._dirMeta['pagePos'], self._dirMeta['allocSize'])
+			self._dirMeta = None
+
+		dictPos = 0
+		if self._dictMeta is not None:
+			dictPos = self._dictMeta['pagePos']
+		payload = [self.dirHeaderStruct.pack(self.plainLen, self.pageStep, dirPos, len(self.pageIndex), len(self.pageTrash), dictPos)]
+		for uncompPos in sorted(self.pageIndex):
+			meta = self.pageIndex[uncompPos]
+			payload.append(self.dirPageStruct.pack(uncompPos, meta['pagePos'], meta['uncompSize'],
+				meta['compSize'], meta['allocSize'], meta['method']))
+		for pagePos, allocSize in self.pageTrash:
+			payload.append(self.dirTrashStruct.pack(pagePos, allocSize))
+		for uncompPos in sorted(self.overlayRecords):
+			for pagePos, allocSize in self.overlayRecords[uncompPos]:
+				payload.append(self.dirTrashStruct.pack(pagePos, allocSize))
+		for uncompPos in sorted(self.refRecords):
+			refMeta = self.refRecords[uncompPos]
+			payload.append(self.dirTrashStruct.pack(refMeta['pagePos'], refMeta['allocSize']))
+		if len(self.ownerHashes) > 0:
+			for uncompPos in sorted(self.ownerHashes):
+				payload.append(self.dirHashStruct.pack(uncompPos, self.ownerHashes[uncompPos]))
+			payload.append("hash" + struct.pack(">Q", len(self.ownerHashes)))
+		payload = "".join(payload)
+		payload += struct.pack(">I", zlib.crc32(payload) & 0xffffffff)
+
+		dirMeta = {'inUse': 0, 'pagePos': dirPos, 'compSize': len(payload), 'uncompPos': 0,
+			'uncompSize': len(payload), 'method': "pdir", 'allocSize': len(payload)}
+		self._write_special_record(dirMeta, payload)
+		if dirPos != fileLen:
+			self.handle.truncate(self.handle.tell())
+
+		self._dirMeta = dirMeta
+		self._dirValid = True
+		self._dirPlainLen = self.plainLen
+
+	def _write_special_record(self, meta, payload):
+
+		#Records that are not pages are marked unused so they are never read as data
+		self.handle.seek(meta['pagePos'])
+		self.handle.write("page")
+		self.handle.write(self.headerStruct.pack(0x00, meta['uncompSize'], meta['compSize'], 0, meta['allocSize']))
+		self.handle.write(meta['method'])
+		self.handle.write(payload)
+		self.handle.seek(meta['pagePos'] + 8 + self.headerStruct.size + meta['allocSize'])
+		self.handle.write(self.footerStruct.pack(meta['allocSize']))
+		self.handle.write("pend")
+
+	def _load_dictionary(self, meta):
+		self.handle.seek(meta['pagePos'] + 8 + self.headerStruct.size)
+		dictionary = self.handle.read(meta['compSize'])
+		self.fileCodecs["zdct"] = ZlibDictCodec("zdct", dictionary)
+		self._dictMeta = meta
+
+	def get_dictionary(self):
+		if "zdct" not in self.fileCodecs:
+			return None
+		return self.fileCodecs["zdct"].dictionary
+
+	def set_dictionary(self, dictionary):
+		"""
+		Store a preset dictionary for the 'zdct' method. Pages that use an
+		older dictionary are first rewritten as plain zlib.
+		"""
+
+		if self.readOnly:
+			raise Exception("Cannot set dictionary in read only mode")
+		if len(dictionary) > 32768:
+			raise ValueError("zlib can only use the last 32768 bytes of a dictionary")
+
+		if self._dictMeta is not None:
+			self.recompress("zlib", fromMethod = "zdct")
+			self._invalidate_page_directory()
+			self._free_extent(self._dictMeta['pagePos'], self._dictMeta['allocSize'])
+			del self.fileCodecs["zdct"]
+			self._dictMeta = None
+
+		self._invalidate_page_directory()
+		pagePos, allocSize = self._allocate_record(len(dictionary))
+
+		meta = {'inUse': 0, 'pagePos': pagePos, 'compSize': len(dictionary), 'uncompPos': 0,
+			'uncompSize': len(dictionary), 'method': "dict", 'allocSize': allocSize}
+		self._write_special_record(meta, dictionary)
+		self.fileCodecs["zdct"] = ZlibDictCodec("zdct", dictionary)
+		self._dictMeta = meta
+
+	def recompress(self, method, fromMethod = None):
+		#Rewrite every page (or those using fromMethod) with a different method
+		#Shared records are rewritten once and stay shared
+		for uncompPos in sorted(self.pageIndex):
+			meta = self.pageIndex[uncompPos]
+			if uncompPos in self.pageOwner:
+				continue
+			if fromMethod is not None and meta['method'] != fromMethod:
+				continue
+			binData = self._read_page_data(meta)
+			plain = self._get_codec(meta['method']).decompress(binData)
+			if method == "auto":
+				meta['method'], encodedData = self._encode_auto(plain)
+			else:
+				meta['method'] = method
+				encodedData = self._get_codec(method).compress(plain, self.level)
+			self._place_encoded_page(meta, plain, encodedData, keepShared = True)
+
+	def _allocate_record(self, size):
+
+		#Find space for a record, from the trash if possible
+		found = None
+		if not self.placeAtEnd:
+			found = self.pageTrash.allocate(size, self.useTrashThreshold)
+		if found is None:
+			return self._end_position(), size
+		pagePos, allocSize, remainder = found
+		if remainder is not None:
+			self._write_free_record(*remainder)
+		return pagePos, allocSize
+
+	def _init_overlay(self):
+		#Deltas for each page in the order written, and the records that hold them
+		self.overlay = {}
+		self.overlayRecords = {}
+		self.overlayBytes = {}
+		self._deltaSeq = 0
+		self._loadedDeltas = []
+
+	def _load_delta(self, meta):
+
+		#Deltas are applied in sequence order once every record is found
+		self.handle.seek(meta['pagePos'] + 8 + self.headerStruct.size)
+		payload = self.handle.read(meta['compSize'])
+		if len(payload) < self.deltaStruct.size + 4 or zlib.crc32(payload[:-4]) & 0xffffffff != struct.unpack(">I", payload[-4:])[0]:
+			self.pageTrash.add(meta['pagePos'], meta['allocSize'])
+			return
+		seq, offset = self.deltaStruct.unpack_from(payload)
+		self._loadedDeltas.append((seq, offset, payload[self.deltaStruct.size:-4], meta['pagePos'], meta['allocSize']))
+
+	def _build_overlay(self):
+
+		self._loadedDeltas.sort()
+		for seq, offset, data, pagePos, allocSize in self._loadedDeltas:
+			uncompPos = offset - (offset % self.pageStep)
+			if uncompPos not in self.pageIndex:
+				#Left over from a page that was removed
+				self.pageTrash.add(pagePos, allocSize)
+				continue
+			self._add_delta(uncompPos, offset - uncompPos, data, pagePos, allocSize)
+			self._deltaSeq = seq + 1
+		self._loadedDeltas = []
+
+	def _add_delta(self, uncompPos, pageCursor, data, pagePos, allocSize):
+		self.overlay.setdefault(uncompPos, []).append((pageCursor, data))
+		self.overlayRecords.setdefault(uncompPos, []).append((pagePos, allocSize))
+		self.overlayBytes[uncompPos] = self.overlayBytes.get(uncompPos, 0) + allocSize + self.recordOverhead
+
+	def _apply_overlay(self, uncompPos, plain):
+		deltas = self.overlay.get(uncompPos)
+		if not deltas:
+			return plain
+		plain = bytearray(plain)
+		for pageCursor, data in deltas:
+			plain[pageCursor:pageCursor+len(data)] = data
+		return str(plain)
+
+	def _clear_overlay(self, uncompPos):
+		#Called once the page itself holds the deltas, or has been removed
+		if uncompPos not in self.overlay:
+			return
+		for pagePos, allocSize in self.overlayRecords.pop(uncompPos):
+			self._free_extent(pagePos, allocSize)
+		del self.overlay[uncompPos]
+		del self.overlayBytes[uncompPos]
+
+	def _use_overlay(self, meta, bytes):
+		if bytes > self.smallWriteBytes:
+			return False
+		maxOverlayBytes = self.maxOverlayBytes
+		if maxOverlayBytes is None:
+			maxOverlayBytes = self.pageStep // 16
+		recordBytes = self.deltaStruct.size + bytes + 4 + self.recordOverhead
+		return self.overlayBytes.get(meta['uncompPos'], 0) + recordBytes <= maxOverlayBytes
+
+	def _write_delta(self, data, meta):
+
+		#Store a small write as a delta record rather than rewriting the page
+		self._invalidate_page_directory()
+		pageCursor = self.virtualCursor - meta['uncompPos']
+		payload = self.deltaStruct.pack(self._deltaSeq, self.virtualCursor) + str(data)
+		payload += struct.pack(">I", zlib.crc32(payload) & 0xffffffff)
+		self._deltaSeq += 1
+
+		pagePos, allocSize = self._allocate_record(len(payload))
+		deltaMeta = {'inUse': 0, 'pagePos': pagePos, 'compSize': len(payload), 'uncompPos': 0,
+			'uncompSize': len(data), 'method': "dlta", 'allocSize': allocSize}
+		self._write_special_record(deltaMeta, payload)
+		self._add_delta(meta['uncompPos'], pageCursor, str(data), pagePos, allocSize)
+		self.stats.count('deltaWrites')
+
+	def merge_overlay(self):
+		"""
+		Rewrite every page that has deltas, so the delta records are freed
+		"""
+		for uncompPos in sorted(self.overlay):
+			meta = self.pageIndex[uncompPos]
+			self._write_page_to_disk(meta, self._read_entire_page(meta))
+
+	def _init_references(self):
+		#Pages that use another page's record, and the reference records that say so
+		self.pageOwner = {}
+		self.sharedPages = {}
+		self.refRecords = {}
+		#Content hash of the record each page owns, and the page that owns each hash
+		self.ownerHashes = {}
+		self.pageHashes = {}
+		self._loadedRefs = []
+		self._loadedHashes = []
+
+	def _load_reference(self, meta):
+
+		#References are matched to records once every record is found
+		self.handle.seek(meta['pagePos'] + 8 + self.headerStruct.size)
+		payload = self.handle.read(meta['compSize'])
+		if len(payload) != self.refStruct.size + 4 or zlib.crc32(payload[:-4]) & 0xffffffff != struct.unpack(">I", payload[-4:])[0]:
+			self.pageTrash.add(meta['pagePos'], meta['allocSize'])
+			return
+		uncompPos, targetPos = self.refStruct.unpack_from(payload)
+		self._loadedRefs.append((uncompPos, targetPos, meta))
+
+	def _build_references(self):
+
+		referrers = set([uncompPos for uncompPos, targetPos, meta in self._loadedRefs])
+		owners = {}
+		for uncompPos in self.pageIndex:
+			pagePos = self.pageIndex[uncompPos]['pagePos']
+			if pagePos not in owners or uncompPos not in referrers:
+				owners[pagePos] = uncompPos
+
+		for uncompPos, targetPos, meta in self._loadedRefs:
+			owner = owners.get(targetPos)
+			current = self.pageIndex.get(uncompPos)
+			if owner is None or owner == uncompPos or uncompPos in self.pageOwner or \
+				(current is not None and current['pagePos'] != targetPos):
+				#Left over from a page that was written again
+				self.pageTrash.add(meta['pagePos'], meta['allocSize'])
+				continue
+			sharedMeta = self.pageIndex[owner]
+			sharedMeta['uncompPos'] = uncompPos
+			self.pageIndex[uncompPos] = sharedMeta
+			self.refRecords[uncompPos] = meta
+			self.pageOwner[uncompPos] = owner
+			self.sharedPages.setdefault(owner, set()).add(uncompPos)
+		self._loadedRefs = []
+
+		#Hashes saved in the directory, so later sessions can share these records
+		for uncompPos, contentHash in self._loadedHashes:
+			if uncompPos in self.pageIndex and uncompPos not in self.pageOwner:
+				self._index_page(uncompPos, contentHash)
+		self._loadedHashes = []
+
+	def _content_hash(self, plain):
+		return hashlib.sha256(plain).digest()
+
+	def _index_page(self, uncompPos, contentHash):
+		self.ownerHashes[uncompPos] = contentHash
+		self.pageHashes[contentHash] = uncompPos
+
+	def _unindex_page(self, uncompPos):
+		contentHash = self.ownerHashes.pop(uncompPos, None)
+		if contentHash is not None and self.pageHashes.get(contentHash) == uncompPos:
+			del self.pageHashes[contentHash]
+
+	def _is_shared(self, uncompPos):
+		return uncompPos in self.pageOwner or uncompPos in self.sharedPages
+
+	def _reference_payload(self, uncompPos, targetPos):
+		payload = self.refStruct.pack(uncompPos, targetPos)
+		return payload + struct.pack(">I", zlib.crc32(payload) & 0xffffffff)
+
+	def _dedup_page(self, meta, contentHash):
+		"""
+		Store a page as a reference to an identical stored page, if there is
+		one. Returns True if the page was stored this way.
+		"""
+		owner = self.pageHashes.get(contentHash)
+		if owner is None:
+			return False
+
+		uncompPos = meta['uncompPos']
+		self._invalidate_page_directory()
+		if owner != uncompPos and self.pageOwner.get(uncompPos) != owner:
+			#Give up the page's current record or reference
+			if meta['pagePos'] is not None:
+				if self._is_shared(uncompPos):
+					self._unshare_page(meta)
+				else:
+					self._unindex_page(uncompPos)
+					self._free_extent(meta['pagePos'], meta['allocSize'])
+
+			ownerMeta = self.pageIndex[owner]
+			payload = self._reference_payload(uncompPos, ownerMeta['pagePos'])
+			pagePos, allocSize = self._allocate_record(len(payload))
+			refMeta = {'inUse': 0, 'pagePos': pagePos, 'compSize': len(payload), 'uncompPos': 0,
+				'uncompSize': len(payload), 'method': "dref", 'allocSize': allocSize}
+			self._write_special_record(refMeta, payload)
+			self.refRecords[uncompPos] = refMeta
+			self.pageOwner[uncompPos] = owner
+			self.sharedPages.setdefault(owner, set()).add(uncompPos)
+
+			ownerMeta['uncompPos'] = uncompPos
+			self.pageIndex[uncompPos] = ownerMeta
+			if uncompPos in self.compressedCache:
+				self.compressedCacheBytes -= len(self.compressedCache.pop(uncompPos)[1])
+
+		#The stored record already holds the data, so any deltas are out of date
+		self._clear_overlay(uncompPos)
+		self.stats.count('pagesDeduplicated')
+		return True
+
+	def _unshare_page(self, meta):
+
+		#Copy on write: the page stops using its shared record, which stays
+		#with the other pages. Afterwards the page has no record.
+		uncompPos = meta['uncompPos']
+		owner = self.pageOwner.pop(uncompPos, None)
+		if owner is not None:
+			sharers = self.sharedPages[owner]
+			sharers.discard(uncompPos)
+			if len(sharers) == 0:
+				del self.sharedPages[owner]
+			refMeta = self.refRecords.pop(uncompPos)
+		else:
+			#Another page takes over the record, so it no longer needs a reference
+			sharers = self.sharedPages.pop(uncompPos)
+			newOwner = min(sharers)
+			sharers.discard(newOwner)
+			del self.pageOwner[newOwner]
+			for other in sharers:
+				self.pageOwner[other] = newOwner
+			if len(sharers) > 0:
+				self.sharedPages[newOwner] = sharers
+			refMeta = self.refRecords.pop(newOwner)
+
+			newMeta = self.pageIndex[newOwner]
+			self.handle.seek(newMeta['pagePos'] + 4)
+			self.handle.write(self.headerStruct.pack(0x01, newMeta['uncompSize'], newMeta['compSize'], newOwner, newMeta['allocSize']))
+			contentHash = self.ownerHashes.pop(uncompPos, None)
+			if contentHash is not None:
+				self._index_page(newOwner, contentHash)
+
+		self._free_extent(refMeta['pagePos'], refMeta['allocSize'])
+		meta['pagePos'] = None
+		meta['compSize'] = None
+		meta['allocSize'] = None
+		self.stats.count('pagesCopiedOnWrite')
+
+	def _move_sharers(self, meta):
+
+		#Pages sharing a record follow it when it is moved or rewritten
+		for other in self.sharedPages.get(meta['uncompPos'], ()):
+			otherMeta = self.pageIndex[other]
+			for key in ('pagePos', 'compSize', 'allocSize', 'method'):
+				otherMeta[key] = meta[key]
+			self.pageIndex[other] = otherMeta
+			self._write_special_record(self.refRecords[other], self._reference_payload(other, meta['pagePos']))
+
+	def compact(self, maxBytes = None):
+		"""
+		Move records so the dictionary and then the pages in logical order
+		are stored one after another with no free space, then shrink the file.
+		About maxBytes of records are moved per call, so compaction may be done
+		in steps while the file is in use. Returns True once the file is compact.
+		"""
+		if self.readOnly:
+			raise Exception("Cannot compact in read only mode")
+
+		#Deltas are merged into their pages first
+		if len(self.overlay) > 0:
+			self.merge_overlay()
+
+		#Pages that share a record are placed by its owner, with the references last
+		records = []
+		if self._dictMeta is not None:
+			records.append(self._dictMeta)
+		records.extend([self.pageIndex[uncompPos] for uncompPos in self.pageIndex.sorted_keys() if uncompPos not in self.pageOwner])
+		records.extend([self.refRecords[uncompPos] for uncompPos in sorted(self.refRecords)])
+
+		#Skip records that are already in place
+		pos = 20
+		i = 0
+		while i < len(records) and records[i]['pagePos'] == pos and records[i]['allocSize'] == records[i]['compSize']:
+			pos += self.recordOverhead + records[i]['allocSize']
+			i += 1
+
+		self.handle.seek(0, 2)
+		fileLen = self.handle.tell()
+		dirAtEnd = self._dirValid and self._dirMeta['pagePos'] == pos
+		if i == len(records) and (fileLen == pos or dirAtEnd):
+			return True
+
+		self._invalidate_page_directory()
+		if self._dirMeta is not None and self._dirMeta['pagePos'] + self.recordOverhead + self._dirMeta['allocSize'] != fileLen:
+			self._free_extent(self._dirMeta['pagePos'], self._dirMeta['allocSize'])
+			self._dirMeta = None
+
+		byPos = dict([(meta['pagePos'], meta) for meta in records[i:]])
+		moved = 0
+		while i < len(records) and (maxBytes is None or moved < maxBytes):
+			meta = records[i]
+			if meta['pagePos'] == pos and meta['allocSize'] - meta['compSize'] >= self.recordOverhead:
+				#Free the unused end of a record that is in place
+				spare = meta['allocSize'] - meta['compSize'] - self.recordOverhead
+				meta['allocSize'] = meta['compSize']
+				self._copy_record(meta, pos, self._read_record_data(meta))
+				self._free_extent(pos + self.recordOverhead + meta['compSize'], spare)
+				continue
+			if meta['pagePos'] == pos and meta['allocSize'] == meta['compSize']:
+				del byPos[pos]
+				pos += self.recordOverhead + meta['allocSize']
+				i += 1
+				continue
+
+			if pos in byPos:
+				#Something else is in the way, or this record has a little unused space
+				moved += self._evacuate_record(byPos, byPos[pos])
+				continue
+
+			#Free space starts here, since everything before is in place
+			if pos not in self.pageTrash.byPos:
+				raise Exception("Unexpected record during compaction")
+			freeSize = self.pageTrash.byPos[pos]
+			freeEnd = pos + self.recordOverhead + freeSize
+			spare = freeSize - meta['compSize']
+			if spare == 0 or spare >= self.recordOverhead:
+				data = self._read_record_data(meta)
+				self.pageTrash.remove(pos)
+				del byPos[meta['pagePos']]
+				oldPos, oldSize = meta['pagePos'], meta['allocSize']
+				meta['allocSize'] = meta['compSize']
+				self._copy_record(meta, pos, data)
+				if spare > 0:
+					self._free_extent(pos + self.recordOverhead + meta['compSize'], spare - self.recordOverhead)
+				self._free_extent(oldPos, oldSize)
+				byPos[pos] = meta
+				moved += self.recordOverhead + meta['compSize']
+
+			elif freeEnd == meta['pagePos']:
+				#Slide the record down into the free space just before it
+				data = self._read_record_data(meta)
+				oldEnd = meta['pagePos'] + self.recordOverhead + meta['allocSize']
+				self.pageTrash.remove(pos)
+				del byPos[meta['pagePos']]
+				meta['allocSize'] = meta['compSize']
+				self._copy_record(meta, pos, data)
+				newEnd = pos + self.recordOverhead + meta['compSize']
+				self._free_extent(newEnd, oldEnd - newEnd - self.recordOverhead)
+				byPos[pos] = meta
+				moved += self.recordOverhead + meta['compSize']
+
+			else:
+				#Make the free space larger by moving the record after it
+				moved += self._evacuate_record(byPos, byPos[freeEnd])
+
+		self.stats.count('compactSteps')
+		self.stats.count('compactBytesMoved', moved)
+		if i < len(records):
+			return False
+
+		#Only free space and the old directory are left after the last record
+		self.pageTrash = FreeExtents(self.recordOverhead)
+		self._dirMeta = None
+		self.handle.truncate(pos)
+		return True
+
+	def _read_record_data(self, meta):
+		self.handle.seek(meta['pagePos'] + 8 + self.headerStruct.size)
+		return self.handle.read(meta['compSize'])
+
+	def _copy_record(self, meta, pagePos, data):
+
+		#Write a record at a new position without decoding it
+		meta['pagePos'] = pagePos
+		if meta['inUse']:
+			self._write_data_page(meta, None, data)
+			self.pageIndex[meta['uncompPos']] = meta
+			self._move_sharers(meta)
+		else:
+			self._write_special_record(meta, data)
+
+	def _evacuate_record(self, byPos, meta):
+
+		#Move a record to the end of the file, out of the way of compaction
+		data = self._read_record_data(meta)
+		oldPos, oldSize = meta['pagePos'], meta['allocSize']
+		del byPos[oldPos]
+		meta['allocSize'] = meta['compSize']
+		self._copy_record(meta, self._end_position(), data)
+		self._free_extent(oldPos, oldSize)
+		byPos[meta['pagePos']] = meta
+		return self.recordOverhead + meta['compSize']
+
+	def truncate(self, size = None):
+		"""
+		Change the length of the file to size, or the current position.
+		Pages past the new end are dropped and the rest of the last page is
+		zeroed, so the area reads as zeros if the file is extended again.
+		"""
+		if self.readOnly:
+			raise Exception("Cannot truncate in read only mode")
+		if size is None:
+			size = self.virtualCursor
+		if size < 0:
+			raise IOError("Invalid argument")
+
+		self._pageCache = []
+		self._metaCache = []
+		keys = self.pageIndex.sorted_keys()
+		for uncompPos in keys[bisect.bisect_right(keys, size - self.pageStep):]:
+			meta = self.pageIndex[uncompPos]
+			if uncompPos >= size:
+				self._drop_page(meta)
+				continue
+			plain = bytearray(self._read_entire_page(meta))
+			plain[size - uncompPos:] = self._zero_bytes(len(plain) - (size - uncompPos))
+			self._write_page_to_disk(meta, plain)
+		self.plainLen = size
+
+	def _get_codec(self, method):
+		if method in self.fileCodecs:
+			return self.fileCodecs[method]
+		if method == "zdct":
+			raise Exception("File has no compression dictionary")
+		return get_codec(method)
 
 	def _parse_header_at_cursor(self):
 		pagePos = self.handle.tell()
@@ -205,41 +1517,109 @@ class CompressedFileLowLevel(object):
 
 		#Seek for suitable page on disk
 		expectedPageStart = pos - (pos % self.pageStep)
-		if expectedPageStart in self.pageIndex:
-			return self.pageIndex[expectedPageStart]
+		return self.pageIndex.get(expectedPageStart)
 
-		return None
+	def _cache_compressed(self, meta, binData):
 
-	def _read_entire_page(self, meta):
+		if self.maxCompressedCacheBytes <= 0:
+			return
+		uncompPos = meta['uncompPos']
+		if uncompPos in self.compressedCache:
+			self.compressedCacheBytes -= len(self.compressedCache.pop(uncompPos)[1])
+		self.compressedCache[uncompPos] = (meta['pagePos'], binData)
+		self.compressedCacheBytes += len(binData)
+
+		while self.compressedCacheBytes > self.maxCompressedCacheBytes:
+			oldPos, (oldPagePos, oldData) = self.compressedCache.popitem(last=False)
+			self.compressedCacheBytes -= len(oldData)
+
+	def _mapped_view(self, pos, length):
+
+		#Remap when the file has grown past the current map. Old maps stay
+		#valid until every view of them is released.
+		if not self.useMmap:
+			return None
+		self.handle.flush()
+		if self._mmap is None or pos + length > len(self._mmap):
+			size = os.fstat(self.handle.fileno()).st_size
+			if pos + length > size or size == 0:
+				return None
+			self._mmap = mmap.mmap(self.handle.fileno(), size, access=mmap.ACCESS_READ)
+			self.mmapRemaps += 1
+		return memoryview(buffer(self._mmap, pos, length))
+
+	def page_view(self, meta):
+		"""
+		Return a memoryview of an uncompressed page in the mapped file, or None
+		if the page is compressed or mapping is off. The view shows the file
+		as it is, so it is only valid until the page is next written.
+		"""
+		if meta['method'] != "null" or meta['uncompPos'] in self.overlay:
+			return None
+		return self._mapped_view(meta['pagePos'] + self.headerStruct.size + 8, meta['compSize'])
+
+	def _read_page_data(self, meta):
+
+		view = self.page_view(meta)
+		if view is not None:
+			return view.tobytes()
+
+		#Compressed data may be cached in memory
+		entry = self.compressedCache.get(meta['uncompPos'])
+		if entry is not None and entry[0] == meta['pagePos'] and len(entry[1]) == meta['compSize']:
+			self.compressedCacheHits += 1
+			self.compressedCache[meta['uncompPos']] = self.compressedCache.pop(meta['uncompPos'])
+			return entry[1]
 
 		self.handle.seek(meta['pagePos'] + self.headerStruct.size + 8)
 		binData = self.handle.read(meta['compSize'])
+		self.compressedCacheMisses += 1
+		self._cache_compressed(meta, binData)
+		return binData
 
-		if meta['method'] == "bz2 ":
-			import bz2
-			plainData = bz2.decompress(binData)
-			if len(plainData) != meta['uncompSize']:
-				raise Exception("Extracted data has incorrect length")
-			return plainData
+	def _pread_page_data(self, meta):
 
-		if meta['method'] == "zlib":
-			import zlib
-			try:
-				plainData = zlib.decompress(binData)
-			except zlib.error as err:
-				if self.debugMode:
-					print "Saving zlib data error info to file..."
-					pickle.dump(binData, open("bindata.dat"), protocol=-1)
-				raise err
-			if len(plainData) != meta['uncompSize']:
-				raise Exception("Extracted data has incorrect length")
-			return plainData
-
-		if meta['method'] == "null":
-			plainData = binData
-			return plainData
-
-		raise Exception("Not implemented")
+		#Read compressed data without using the shared file position, so
+		#several threads may call this at once
+		pos = meta['pagePos'] + self.headerStruct.size + 8
+		if hasattr(os, "pread"):
+			return os.pread(self.handle.fileno(), meta['compSize'], pos)
+		with self._ioLock:
+			self.handle.seek(pos)
+			return self.handle.read(meta['compSize'])
+
+	def _read_entire_page(self, meta):
+
+		binData = self._read_page_data(meta)
+		return self._decode_page(meta, binData)
+
+	def _stats_gauges(self):
+		return {'pages': len(self.pageIndex), 'plainLen': self.plainLen,
+			'trashBytes': self.pageTrash.total_size(), 'trashExtents': len(self.pageTrash),
+			'compressedCacheBytes': self.compressedCacheBytes, 'sharedRecords': len(self.sharedPages),
+			'pageReferences': len(self.pageOwner)}
+
+	def stats_snapshot(self):
+		#Counters and timings, with the current size of the index and trash
+		return self.stats.snapshot(self._stats_gauges())
+
+	def _decode_page(self, meta, binData):
+
+		#Does not touch the file, so may be called from worker threads
+		codec = self._get_codec(meta['method'])
+		startTime = time.time()
+		try:
+			plainData = codec.decompress(binData)
+		except Exception:
+			if self.debugMode:
+				import pickle
+				print "Saving compressed data error info to file..."
+				pickle.dump(binData, open("bindata.dat", "wb"), protocol=-1)
+			raise
+		self.stats.record_codec(meta['method'], "decompress", len(binData), len(plainData), time.time() - startTime)
+		if len(plainData) != meta['uncompSize']:
+			raise Exception("Extracted data has incorrect length")
+		return self._apply_overlay(meta['uncompPos'], plainData)
 
 	def read(self, bytes=None):
 		self._pageCache = []
@@ -270,7 +1650,15 @@ class CompressedFileLowLevel(object):
 				bytes = bytesRemainingInFile	
 
 			self.virtualCursor += bytes
-			return "".join("\x00" for i in range(bytes))
+			return self._zero_bytes(bytes)
+
+		view = self.page_view(meta)
+		if view is not None:
+			#Mapped pages are cheap to read again, so they are not passed on for caching
+			pageCursor = self.virtualCursor - meta['uncompPos']
+			bytes = min(bytes, len(view) - pageCursor, self.plainLen - self.virtualCursor)
+			self.virtualCursor += bytes
+			return view[pageCursor:pageCursor+bytes].tobytes()
 
 		#Read a page from disk
 		plain = self._read_entire_page(meta)
@@ -290,6 +1678,26 @@ class CompressedFileLowLevel(object):
 
 		return plain[pageCursor:pageCursor+bytes]
 
+	def _readinto_page(self, meta, pageCursor, view):
+
+		#Uncompressed pages are copied straight from the file into the view
+		count = min(len(view), max(meta['uncompSize'] - pageCursor, 0))
+		mapped = self.page_view(meta)
+		if mapped is not None:
+			view[:count] = mapped[pageCursor:pageCursor+count]
+			got = count
+		elif hasattr(self.handle, "readinto"):
+			self.handle.seek(meta['pagePos'] + self.headerStruct.size + 8 + pageCursor)
+			got = self.handle.readinto(view[:count])
+		else:
+			self.handle.seek(meta['pagePos'] + self.headerStruct.size + 8 + pageCursor)
+			data = self.handle.read(count)
+			got = len(data)
+			view[:got] = data
+		if got < len(view):
+			view[got:] = self._zero_bytes(len(view) - got)
+		return len(view)
+
 	def tell(self):
 		return self.virtualCursor
 
@@ -315,83 +1723,321 @@ class CompressedFileLowLevel(object):
 	def __len__(self):
 		return self.plainLen
 
+	def iter_extents(self):
+		"""
+		Yield (start, length) for each range of the file that is stored in
+		pages, in order. Anything outside these ranges reads as zeros.
+		"""
+		return _merge_extents(self.pageIndex.sorted_keys(), self.pageStep, self.plainLen)
+
+	def _has_page(self, uncompPos):
+		return uncompPos in self.pageIndex
+
+	def _next_data_page(self, pageStart):
+		return _next_page_start(self.pageIndex.sorted_keys(), pageStart)
+
+	def seek_data(self, pos):
+		#Move to the first stored data at or after pos, like lseek with SEEK_DATA
+		self.virtualCursor = _seek_data(self, pos, self.pageStep)
+		return self.virtualCursor
+
+	def seek_hole(self, pos):
+		#Move to the first hole at or after pos, like lseek with SEEK_HOLE
+		self.virtualCursor = _seek_hole(self, pos, self.pageStep)
+		return self.virtualCursor
+
+	def write_pages(self, pages, pool = None):
+		"""
+		Write whole pages, given as a list of (uncompPos, plain) pairs
+		Pages are compressed by the worker pool if one is given, then
+		placed in the file one at a time. The file length is not changed.
+		If a page is given more than once, the last data given is kept.
+		"""
+
+		latest = {}
+		for uncompPos, plain in pages:
+			if uncompPos % self.pageStep != 0 or len(plain) != self.pageStep:
+				raise ValueError("Only whole pages can be written")
+			latest[uncompPos] = plain
+		pages = [(uncompPos, latest.pop(uncompPos)) for uncompPos, plain in pages if uncompPos in latest]
+
+		metas = []
+		for uncompPos, plain in pages:
+			meta = self.pageIndex.get(uncompPos)
+			if meta is None:
+				meta = self._new_page_meta(uncompPos)
+			metas.append(meta)
+
+		jobs = []
+		hashes = []
+		repeats = []
+		for meta, (uncompPos, plain) in zip(metas, pages):
+			if self._is_zero(plain):
+				self._drop_page(meta)
+				continue
+			contentHash = None
+			if self.dedup:
+				contentHash = self._content_hash(plain)
+				if self._dedup_page(meta, contentHash):
+					continue
+				if contentHash in hashes:
+					#Shares the record of an earlier page in this batch once that is placed
+					repeats.append((meta, plain, contentHash))
+					continue
+			jobs.append((meta, plain))
+			hashes.append(contentHash)
+
+		if pool is None:
+			encoded = [self._encode_page(meta, plain) for meta, plain in jobs]
+		else:
+			encoded = pool.map(self._encode_page, jobs)
+
+		for (meta, plain), encodedData, contentHash in zip(jobs, encoded, hashes):
+			self._place_encoded_page(meta, plain, encodedData, contentHash)
+		for meta, plain, contentHash in repeats:
+			if not self._dedup_page(meta, contentHash):
+				self._write_page_to_disk(meta, plain)
+
+	def read_pages(self, metas, pool = None):
+		"""
+		Read and decompress several pages, returning the plain data in the
+		order given. Compressed data is read in file order and decompressed
+		by the worker pool if one is given.
+		"""
+
+		binData = [None] * len(metas)
+		for i in sorted(range(len(metas)), key=lambda i: metas[i]['pagePos']):
+			binData[i] = self._read_page_data(metas[i])
+
+		jobs = zip(metas, binData)
+		if pool is None:
+			return [self._decode_page(meta, data) for meta, data in jobs]
+		return pool.map(self._decode_page, jobs)
+
+	def _is_zero(self, data):
+		return data.count("\x00") == len(data)
+
+	def _zero_bytes(self, bytes):
+		#Holes are served from a shared buffer of zeros
+		if bytes == self.pageStep:
+			return self.zeroPage
+		if bytes < self.pageStep:
+			return self.zeroPage[:bytes]
+		return "\x00" * bytes
+
+	def _drop_page(self, meta):
+
+		#Remove a page from the file, so its area reads as zeros
+		if meta['pagePos'] is None:
+			return
+		self._invalidate_page_directory()
+		if self._is_shared(meta['uncompPos']):
+			self._unshare_page(meta)
+		else:
+			self._unindex_page(meta['uncompPos'])
+			self._free_extent(meta['pagePos'], meta['allocSize'])
+		del self.pageIndex[meta['uncompPos']]
+		self._clear_overlay(meta['uncompPos'])
+		self.stats.count('pagesDropped')
+		if meta['uncompPos'] in self.compressedCache:
+			self.compressedCacheBytes -= len(self.compressedCache.pop(meta['uncompPos'])[1])
+
 	def _write_page_to_disk(self, meta, plain):
 
-		encodedData = None
+		#Pages that are rewritten as zeros are dropped
+		if self._is_zero(plain):
+			self._drop_page(meta)
+			return
 
-		if meta['method'] == "bz2 ":
-			import bz2
-			encodedData = bz2.compress(plain)
+		contentHash = None
+		if self.dedup:
+			contentHash = self._content_hash(plain)
+			if self._dedup_page(meta, contentHash):
+				return
 
-		if meta['method'] == "zlib":
-			import zlib
-			encodedData = zlib.compress(str(plain))
+		encodedData = self._encode_page(meta, plain)
+		self._place_encoded_page(meta, plain, encodedData, contentHash)
 
-		if meta['method'] == "null":
-			encodedData = plain
+	def _encode_page(self, meta, plain):
 
-		if encodedData == None:
-			raise Exception("Not implemented compression: '" + meta['method'] + "'")
+		#Does not touch the file, so may be called from worker threads
+		startTime = time.time()
+		if self.method == "auto":
+			meta['method'], encodedData = self._encode_auto(plain)
+		else:
+			encodedData = self._get_codec(meta['method']).compress(plain, self.level)
+		self.stats.record_codec(meta['method'], "compress", len(plain), len(encodedData), time.time() - startTime)
+		return encodedData
+
+	def _encode_auto(self, plain):
+
+		#Pages that do not compress are stored as they are
+		sample = str(plain[:65536])
+		if len(zlib.compress(sample, 1)) >= len(sample) * self.autoMinRatio:
+			return "null", str(plain)
+
+		#Try codecs in order of cost until the time budget is used up
+		startTime = time.time()
+		best = None
+		for method in self.autoMethods:
+			if method not in self.fileCodecs and method not in codecs:
+				continue
+			codec = self._get_codec(method)
+			if not codec.available():
+				continue
+			if best is not None and time.time() - startTime >= self.autoTimeBudget:
+				break
+			encodedData = codec.compress(plain, self.level)
+			if best is None or len(encodedData) < len(best[1]):
+				best = (method, encodedData)
 
-		if meta['uncompPos'] not in self.pageIndex:
-			self.pageIndex[meta['uncompPos']] = meta
+		if best is None or len(best[1]) >= len(plain) * self.autoMinRatio:
+			return "null", str(plain)
+		return best
+
+	def _place_encoded_page(self, meta, plain, encodedData, contentHash = None, keepShared = False):
+
+		self._invalidate_page_directory()
+
+		#A page that shares a record gets its own, unless the record itself is
+		#being rewritten with the same content
+		if not keepShared:
+			if self._is_shared(meta['uncompPos']):
+				self._unshare_page(meta)
+			else:
+				self._unindex_page(meta['uncompPos'])
 
 		#Does this fit in original location
 		if meta['pagePos'] is not None and len(encodedData) <= meta['compSize']:
-			pass
+			self.stats.count('pagesInPlace')
 			#print "Write page at existing position"
 
+		elif meta['pagePos'] is not None and meta['pagePos'] + self.recordOverhead + meta['allocSize'] == self._end_position():
+			#The last page in the file can grow where it is
+			meta['allocSize'] = max(meta['allocSize'], len(encodedData))
+			self.stats.count('pagesInPlace')
+
 		else:
 			if meta['pagePos'] is not None:
 				#Free old location
-				self._set_page_unused(meta)
-				trashMeta = copy.deepcopy(meta)
-				self.pageTrash.append(trashMeta)
+				self._free_extent(meta['pagePos'], meta['allocSize'])
+				self.stats.count('pagesRelocated')
 
 			#Try to use a trash page
-			bestTPage = None
-			bestSize = None
-			bestIndex = None
-			for i, tpage in enumerate(self.pageTrash):
-				if tpage['allocSize'] < len(encodedData):
-					continue #Too small
-				if tpage['allocSize'] * self.useTrashThreshold > len(encodedData):
-					continue #Too too big
-				if bestSize is None or tpage['allocSize'] < bestSize:
-					bestSize = tpage['allocSize']
-					bestTPage = tpage
-					bestIndex = i
-
-			if bestTPage is not None:
-				#print "Write existing page to larger area"
-				#Write to trash page
-				meta['pagePos'] = bestTPage['pagePos']
-				meta['allocSize'] = bestTPage['allocSize']
-				del self.pageTrash[bestIndex]
+			found = None
+			if not self.placeAtEnd:
+				found = self.pageTrash.allocate(len(encodedData), self.useTrashThreshold)
+			if found is not None:
+				#print "Write existing page to trash area"
+				meta['pagePos'], meta['allocSize'], remainder = found
+				if remainder is not None:
+					self._write_free_record(*remainder)
+				self.stats.count('pagesToTrash')
 			else:
 				#print "Write existing page at end of file"
 				#Write at end of file
-				self.handle.seek(0, 2)
-				meta['pagePos'] = self.handle.tell()
+				meta['pagePos'] = self._end_position()
 				meta['allocSize'] = len(encodedData)
+				self.stats.count('pagesToEnd')
 
 		meta['compSize'] = len(encodedData)
+		self.pageIndex[meta['uncompPos']] = meta
 
 		#Write to disk
 		self._write_data_page(meta, plain, encodedData)
-
-	def _set_page_unused(self, meta):
-
-		self.handle.seek(meta['pagePos'])
+		self._cache_compressed(meta, encodedData)
+		if keepShared:
+			self._move_sharers(meta)
+			return
+		self._clear_overlay(meta['uncompPos'])
+		if self.dedup:
+			if contentHash is None:
+				contentHash = self._content_hash(plain)
+			self._index_page(meta['uncompPos'], contentHash)
+
+	def _end_position(self):
+
+		#A directory left at the end of the file by the last flush is overwritten
+		self.handle.seek(0, 2)
+		fileLen = self.handle.tell()
+		if self._dirMeta is not None and not self._dirValid:
+			if self._dirMeta['pagePos'] + self.recordOverhead + self._dirMeta['allocSize'] == fileLen:
+				fileLen = self._dirMeta['pagePos']
+				self.handle.truncate(fileLen)
+				self._dirMeta = None
+		return fileLen
+
+	def _free_extent(self, pagePos, allocSize):
+		#Return space to the trash, merged with any neighbouring free space
+		freedStart, freedEnd = pagePos, pagePos + self.recordOverhead + allocSize
+		pagePos, allocSize, prevSize, nextSize = self.pageTrash.add(pagePos, allocSize)
+		if self._shrink_tail(pagePos, allocSize):
+			return
+		self._write_free_record(pagePos, allocSize)
+		self._punch_free_space(pagePos, allocSize, freedStart, freedEnd, prevSize, nextSize)
+
+	def _shrink_tail(self, pagePos, allocSize):
+
+		#Free space at the end of the file, or just before a stale directory
+		#at the end, is removed by truncating the file
+		end = pagePos + self.recordOverhead + allocSize
+		self.handle.seek(0, 2)
+		fileLen = self.handle.tell()
+		staleDir = self._dirMeta is not None and not self._dirValid and self._dirMeta['pagePos'] == end \
+			and end + self.recordOverhead + self._dirMeta['allocSize'] == fileLen
+		if end != fileLen and not staleDir:
+			return False
+		self.pageTrash.remove(pagePos)
+		if staleDir:
+			self._dirMeta = None
+		self.handle.truncate(pagePos)
+		self.stats.count('tailBytesTruncated', fileLen - pagePos)
+		return True
+
+	def _punch_free_space(self, pagePos, allocSize, freedStart, freedEnd, prevSize, nextSize):
+
+		#Release the part that was just freed once the free record is large
+		#enough, along with any merged neighbour that was too small to have
+		#been released on its own
+		if self.punchHoleBytes is None or allocSize < self.punchHoleBytes:
+			return
+		dataStart = pagePos + 8 + self.headerStruct.size
+		dataEnd = dataStart + allocSize
+		if prevSize is not None and prevSize >= self.punchHoleBytes:
+			dataStart = max(freedStart, dataStart)
+		if nextSize is not None and nextSize >= self.punchHoleBytes:
+			dataEnd = min(freedEnd, dataEnd)
+
+		#Only whole file system blocks can be released
+		start = dataStart + (-dataStart % self.punchAlign)
+		end = dataEnd - dataEnd % self.punchAlign
+		if end <= start:
+			return
+		if self._canPunch:
+			self._canPunch = punch_hole(self.handle, start, end - start)
+		if not self._canPunch:
+			if not self.zeroFillHoles:
+				return
+			self.handle.seek(start)
+			for chunkStart in range(start, end, self.pageStep):
+				self.handle.write(self._zero_bytes(min(self.pageStep, end - chunkStart)))
+		self.stats.count('holeBytesPunched', end - start)
+
+	def _write_free_record(self, pagePos, allocSize):
+
+		self.handle.seek(pagePos)
 		#print "Set page to unused"
 
 		#Header
 		self.handle.write("page")
-		header = self.headerStruct.pack(0x00, 0, 0, 0, meta['allocSize'])
+		header = self.headerStruct.pack(0x00, 0, 0, 0, allocSize)
 		self.handle.write(header)
 		self.handle.write("free")
 
-		#Leave footer unchanged
+		#Footer
+		self.handle.seek(pagePos + 8 + self.headerStruct.size + allocSize)
+		self.handle.write(self.footerStruct.pack(allocSize))
+		self.handle.write("pend")
 
 	def _write_data_page(self, meta, data, encoded):
 
@@ -435,6 +2081,133 @@ def MultiRead(handle, maxLen):
 		else:
 			return "".join(buff)
 
+class PendingResult(object):
+
+	"""
+	Result of a job submitted to a WorkerPool or an AsyncCompressedFile
+	"""
+
+	def __init__(self):
+		self._done = threading.Event()
+		self._value = None
+		self._excInfo = None
+		self._lock = threading.Lock()
+		self._callbacks = []
+
+	def _set(self, value, excInfo):
+		self._value = value
+		self._excInfo = excInfo
+		with self._lock:
+			self._done.set()
+			callbacks, self._callbacks = self._callbacks, []
+		for func in callbacks:
+			self._run_callback(func)
+
+	def _run_callback(self, func):
+		#A failing callback must not stop the thread that completed the job
+		try:
+			func(self)
+		except Exception:
+			pass
+
+	def add_done_callback(self, func):
+		"""
+		Call func with this result once it is done, from the thread that
+		completes it, or straight away if it is already done. An event loop
+		can hand the result back to its own thread, for example with
+		call_soon_threadsafe, without blocking in result().
+		"""
+		with self._lock:
+			if not self._done.is_set():
+				self._callbacks.append(func)
+				return
+		self._run_callback(func)
+
+	def done(self):
+		return self._done.is_set()
+
+	def result(self):
+		self._done.wait()
+		if self._excInfo is not None:
+			raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+		return self._value
+
+class WorkerPool(object):
+
+	"""
+	A fixed set of daemon threads that run submitted jobs in order
+	Used for codec work, since zlib and bz2 release the GIL
+	"""
+
+	def __init__(self, numThreads = 1):
+		self.jobs = Queue.Queue()
+		self.threads = []
+		for i in range(numThreads):
+			thread = threading.Thread(target=self._run)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def _run(self):
+		while True:
+			job = self.jobs.get()
+			if job is None:
+				return
+			result, func, args = job
+			try:
+				result._set(func(*args), None)
+			except Exception:
+				result._set(None, sys.exc_info())
+
+	def submit(self, func, *args):
+		result = PendingResult()
+		self.jobs.put((result, func, args))
+		return result
+
+	def map(self, func, argsList):
+		pending = [self.submit(func, *args) for args in argsList]
+		return [result.result() for result in pending]
+
+	def close(self):
+		for thread in self.threads:
+			self.jobs.put(None)
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+
+def _synchronised(func):
+	#Methods that touch the page cache hold the file lock while writeback runs
+	def wrapper(self, *args, **kwargs):
+		if self._writebackThread is None:
+			return func(self, *args, **kwargs)
+		with self._lock:
+			return func(self, *args, **kwargs)
+	wrapper.__name__ = func.__name__
+	wrapper.__doc__ = func.__doc__
+	return wrapper
+
+def _writeback_loop(fileRef, cond, stop, interval):
+	#Only a weak reference is held, so dropping the file still runs its __del__
+	busy = False
+	while True:
+		if not busy:
+			with cond:
+				if not stop.is_set():
+					cond.wait(interval)
+		if stop.is_set():
+			return
+		cfile = fileRef()
+		if cfile is None:
+			return
+		try:
+			busy = cfile._writeback_once()
+		except Exception:
+			with cond:
+				cfile._writebackError = sys.exc_info()
+				cond.notify_all()
+			return
+		del cfile
+
 # ****************************************************************************
 
 class CompressedFile(object):
@@ -443,35 +2216,166 @@ class CompressedFile(object):
 	Extends the functionality of CompressedFileLowLevel
 	Provides memory caching of data for faster reads and writes
 	Writes are lazy and done before the memory page is removed
+	Cached pages are evicted in least recently used order to stay within maxCacheBytes
+	Compressed data can also be cached, within maxCompressedCacheBytes
+	Sequential reads can decompress up to readahead pages ahead in a background thread
+	Dirty pages are compressed by compressThreads threads when written back
+	Reads of at least largeReadPages pages are decompressed by decompressThreads threads
+	In streaming mode new pages are filled in memory and compressed once, when
+	they are full or on flush, then placed in order at the end of the file
+	Writes of up to smallWriteBytes to pages that are not cached are kept as
+	delta records by the low level file, rather than rewriting the page
+	With writeback, a background thread writes dirty pages once there are more
+	than dirtyLowBytes of them or they are older than dirtyExpireSeconds.
+	Writers wait while there are more than dirtyHighBytes.
+	With dedup, pages identical to a page already written share its record.
+	Content hashes are saved in the page directory on flush, so pages written
+	in earlier sessions are matched too. If the file was not flushed, pages
+	are only matched against those written since it was opened.
 	"""
 
-	def __init__(self, handle, readOnly=False, createFile = False, method = "zlib"):
+	cacheReads = _stat_property('cacheReads')
+	cacheWrites = _stat_property('cacheWrites')
+	diskReads = _stat_property('diskReads')
+	diskWrites = _stat_property('diskWrites')
+
+	def __init__(self, handle, readOnly=False, createFile = False, method = "zlib", maxCacheBytes = 50000000,
+		maxCompressedCacheBytes = 0, readahead = 0, compressThreads = 1, decompressThreads = 1,
+		largeReadPages = 8, level = None, pageStep = 1000000, useMmap = False, streaming = False,
+		smallWriteBytes = 0, writeback = False, dirtyLowBytes = None, dirtyHighBytes = None,
+		dirtyExpireSeconds = 5.0, dedup = False):
 		
 		self.virtualCursor = 0
-		self.maxCachePages = 50
-
-		self.cacheReads = 0
-		self.cacheWrites = 0
-		self.diskReads = 0
-		self.diskWrites = 0
+		self.maxCacheBytes = maxCacheBytes
+		self.cacheBytes = 0
 
-		#Index of in memory pages
-		self.pagesPlain = {}
+		#Index of in memory pages, ordered from least to most recently used
+		self.pagesPlain = collections.OrderedDict()
 		self.pagesChanged = {}
-		self.pagesLastUsed = {}
+
+		#Dirty pages, with the time each became dirty and a number that changes on every write
+		self.dirtyBytes = 0
+		self._dirtySince = {}
+		self._pageVersions = {}
+		self._changeCount = 0
+		self._writebackThread = None
+
+		#Readahead window in pages, which grows while reads are sequential
+		self.readaheadMax = readahead
+		self.readaheadWindow = 0
+		self._lastReadEnd = None
+		self._readaheadPending = {}
+		self._readaheadPool = None
+		self._readaheadFile = None
+
+		self.compressThreads = compressThreads
+		self._compressPool = None
+		self.decompressThreads = decompressThreads
+		self.largeReadPages = largeReadPages
+		self._decompressPool = None
 
 		self.handle = None
 		if isinstance(handle, CompressedFileLowLevel):
 			self.handle = handle
 		else:
-			self.handle = CompressedFileLowLevel(handle, readOnly, createFile, method)
+			self.handle = CompressedFileLowLevel(handle, readOnly, createFile, method, level, pageStep, useMmap)
+
+		#Counters and timings are shared with the low level file
+		self.stats = self.handle.stats
+		self.cacheReads = 0
+		self.cacheWrites = 0
+		self.diskReads = 0
+		self.diskWrites = 0
 
 		if readOnly:
 			self.handle.readOnly = readOnly
+		if maxCompressedCacheBytes:
+			self.handle.maxCompressedCacheBytes = maxCompressedCacheBytes
+		if smallWriteBytes:
+			self.handle.smallWriteBytes = smallWriteBytes
+		self.handle.dedup = dedup
+
+		#Full pages waiting to be compressed together in streaming mode
+		self.streaming = streaming
+		self._streamFull = []
+		if streaming:
+			self.handle.placeAtEnd = True
+
+		if writeback:
+			self.start_writeback(dirtyLowBytes, dirtyHighBytes, dirtyExpireSeconds)
+
+	def start_writeback(self, dirtyLowBytes = None, dirtyHighBytes = None, dirtyExpireSeconds = 5.0, interval = 0.1):
+		"""
+		Start a thread that compresses and writes dirty pages in the background.
+		The watermarks default to a quarter and a half of the cache size.
+		"""
+		if self._writebackThread is not None:
+			return
+		if dirtyLowBytes is None:
+			dirtyLowBytes = self.maxCacheBytes // 4
+		if dirtyHighBytes is None:
+			dirtyHighBytes = self.maxCacheBytes // 2
+		self.dirtyLowBytes = dirtyLowBytes
+		self.dirtyHighBytes = max(dirtyHighBytes, dirtyLowBytes)
+		self.dirtyExpireSeconds = dirtyExpireSeconds
+		self._writebackError = None
+		self._lock = threading.Lock()
+		self._writebackCond = threading.Condition(self._lock)
+		self._writebackStop = threading.Event()
+		thread = threading.Thread(target=_writeback_loop,
+			args=(weakref.ref(self), self._writebackCond, self._writebackStop, interval))
+		thread.daemon = True
+		thread.start()
+		self._writebackThread = thread
+
+	def stop_writeback(self):
+		#Stop the writeback thread. Dirty pages stay in the cache until flushed.
+		thread = self._writebackThread
+		if thread is None:
+			return
+		with self._lock:
+			self._writebackStop.set()
+			self._writebackCond.notify_all()
+		if thread is not threading.current_thread():
+			thread.join()
+		self._writebackThread = None
 
 	def __del__(self):
+		self.stop_writeback()
 		self.flush()
+		if self._readaheadPool is not None:
+			self._readaheadPool.close()
+			self._readaheadPool = None
+		if self._readaheadFile:
+			self._readaheadFile.close()
+			self._readaheadFile = None
+		if self._compressPool is not None:
+			self._compressPool.close()
+			self._compressPool = None
+		if self._decompressPool is not None:
+			self._decompressPool.close()
+			self._decompressPool = None
+
+	def _stats_gauges(self):
+		return {'pageCacheBytes': self.cacheBytes, 'pageCachePages': len(self.pagesPlain),
+			'dirtyPages': len(self._dirtySince), 'dirtyBytes': self.dirtyBytes}
+
+	@_synchronised
+	def stats_snapshot(self):
+		#Counters and timings, with the current state of the caches, index and trash
+		gauges = self.handle._stats_gauges()
+		gauges.update(self._stats_gauges())
+		return self.stats.snapshot(gauges)
+
+	def cache_stats(self):
+		#Hit and miss counts for the page cache and the compressed data cache
+		return {'pageCacheHits': self.cacheReads, 'pageCacheMisses': self.diskReads,
+			'pageCacheBytes': self.cacheBytes,
+			'compressedCacheHits': self.handle.compressedCacheHits,
+			'compressedCacheMisses': self.handle.compressedCacheMisses,
+			'compressedCacheBytes': self.handle.compressedCacheBytes}
 		
+	@_synchronised
 	def flush(self):
 
 		if self.handle is None:
@@ -480,36 +2384,201 @@ class CompressedFile(object):
 		if self.handle.readOnly:
 			return
 
-		for i, uncompPos in enumerate(self.pagesChanged):
-			changed = self.pagesChanged[uncompPos]
-			if not changed:
-				continue
-	
-			page = self.pagesPlain[uncompPos]
-			self.handle.seek(uncompPos)
-			self.handle.write(page, disableLengthUpdate = 1)
-			self.pagesChanged[uncompPos] = False
-
+		startTime = time.time()
+		self._write_dirty_pages()
 		self.handle.flush()
+		self.stats.record_latency("flush", time.time() - startTime)
+
+	def _write_dirty_pages(self):
+		dirty = [(uncompPos, self.pagesPlain[uncompPos]) for uncompPos, changed in self.pagesChanged.iteritems() if changed]
+		self._write_pages(dirty)
+		for uncompPos, page in dirty:
+			self._set_changed(uncompPos, False)
+
+	@_synchronised
+	def truncate(self, size = None):
+		"""
+		Change the length of the file to size, or the current position.
+		The cursor is not moved.
+		"""
+		if self.handle.readOnly:
+			raise Exception("Compressed file is in read only mode")
+		if size is None:
+			size = self.virtualCursor
+		if size < 0:
+			raise IOError("Invalid argument")
+
+		#Cached pages past the new end are discarded and the last page is zeroed
+		pageStep = self.handle.pageStep
+		for uncompPos in list(self._readaheadPending):
+			if uncompPos + pageStep > size:
+				del self._readaheadPending[uncompPos]
+		for uncompPos in [pos for pos in self.pagesPlain if pos + pageStep > size]:
+			if uncompPos >= size:
+				self._set_changed(uncompPos, False)
+				del self.pagesChanged[uncompPos]
+				self.cacheBytes -= len(self.pagesPlain.pop(uncompPos))
+			else:
+				page = self.pagesPlain[uncompPos]
+				page[size - uncompPos:] = self.handle._zero_bytes(len(page) - (size - uncompPos))
+				self._set_changed(uncompPos, True)
+		self.handle.truncate(size)
+
+	@_synchronised
+	def compact(self, maxBytes = None):
+		"""
+		Compact the file in steps of about maxBytes, returning True once done.
+		Changed pages in the cache are written first so they are included.
+		"""
+		if self.handle.readOnly:
+			raise Exception("Compressed file is in read only mode")
+		self._write_dirty_pages()
+		return self.handle.compact(maxBytes)
 
-	def _flush_old_pages(self, minToRemove=1):
-
-		sortableList = zip(self.pagesLastUsed.values(), self.pagesLastUsed.keys())
-		sortableList.sort()
-		cutIndex = int(round(len(sortableList) * 0.1))
-		if cutIndex < minToRemove:
-			cutIndex = minToRemove
-		toRemove = sortableList[:cutIndex]
+	def _write_pages(self, pages):
 
-		for lastUsed, ind in toRemove:
-			#Write update page to disk
+		#Compress in parallel, then place pages in the file in logical order
+		if len(pages) == 0:
+			return
+		pages.sort(key=lambda item: item[0])
+		if self.compressThreads > 1 and len(pages) > 1 and self._compressPool is None:
+			self._compressPool = WorkerPool(self.compressThreads)
+		pool = self._compressPool if len(pages) > 1 else None
+		self.handle.write_pages(pages, pool)
+
+	def _flush_old_pages(self, minToRemove=0):
+
+		#Evict least recently used pages until the cache is within budget
+		removed = 0
+		dirty = []
+		while len(self.pagesPlain) > 0 and (self.cacheBytes > self.maxCacheBytes or removed < minToRemove):
+			ind, page = self.pagesPlain.popitem(last=False)
 			if self.pagesChanged[ind]:
-				self.handle.seek(ind)
-				self.handle.write(self.pagesPlain[ind], disableLengthUpdate = 1)
-
-			del self.pagesPlain[ind]
+				dirty.append((ind, page))
+				self._set_changed(ind, False)
 			del self.pagesChanged[ind]
-			del self.pagesLastUsed[ind]
+			self.cacheBytes -= len(page)
+			removed += 1
+		self.stats.count('pageEvictions', removed)
+		self.stats.count('dirtyPageEvictions', len(dirty))
+
+		#Write updated pages to disk
+		self._write_pages(dirty)
+
+	def _set_changed(self, uncompPos, changed):
+
+		#Keep count of dirty bytes for the writeback thread
+		if changed:
+			if not self.pagesChanged.get(uncompPos):
+				self.dirtyBytes += self.handle.pageStep
+				self._dirtySince[uncompPos] = time.time()
+			self._changeCount += 1
+			self._pageVersions[uncompPos] = self._changeCount
+		elif self.pagesChanged.get(uncompPos):
+			self.dirtyBytes -= self.handle.pageStep
+			del self._dirtySince[uncompPos]
+			del self._pageVersions[uncompPos]
+		self.pagesChanged[uncompPos] = changed
+
+	def _writeback_once(self):
+
+		#Choose the oldest dirty pages that are past their age or above the low watermark
+		with self._lock:
+			now = time.time()
+			byAge = sorted([(since, uncompPos) for uncompPos, since in self._dirtySince.iteritems()])
+			jobs = []
+			deduplicated = 0
+			excess = self.dirtyBytes - self.dirtyLowBytes
+			for since, uncompPos in byAge[:max(self.compressThreads, 1) * 2]:
+				if excess <= 0 and now - since < self.dirtyExpireSeconds:
+					break
+				excess -= self.handle.pageStep
+				meta = self.handle.pageIndex.get(uncompPos)
+				if meta is None:
+					meta = self.handle._new_page_meta(uncompPos)
+				plain = str(self.pagesPlain[uncompPos])
+
+				#Pages that match a stored page need no compression
+				if self.handle.dedup and not self.handle._is_zero(plain) and \
+					self.handle._dedup_page(meta, self.handle._content_hash(plain)):
+					self._set_changed(uncompPos, False)
+					self.diskWrites += 1
+					self.stats.count('writebackPages')
+					deduplicated += 1
+					continue
+				jobs.append((uncompPos, self._pageVersions[uncompPos], dict(meta), plain))
+			if deduplicated > 0:
+				self._writebackCond.notify_all()
+			if self.compressThreads > 1 and len(jobs) > 1 and self._compressPool is None:
+				self._compressPool = WorkerPool(self.compressThreads)
+			pool = self._compressPool if len(jobs) > 1 else None
+		if len(jobs) == 0:
+			return deduplicated > 0
+
+		#Compress without the lock, so writers carry on meanwhile
+		toEncode = [(meta, plain) for uncompPos, version, meta, plain in jobs]
+		if pool is None:
+			encoded = [self._encode_dirty_page(meta, plain) for meta, plain in toEncode]
+		else:
+			encoded = pool.map(self._encode_dirty_page, toEncode)
+
+		with self._lock:
+			for (uncompPos, version, meta, plain), encodedData in zip(jobs, encoded):
+				#Skip pages written or evicted since they were copied
+				if not self.pagesChanged.get(uncompPos) or self._pageVersions.get(uncompPos) != version:
+					continue
+				current = self.handle.pageIndex.get(uncompPos)
+				if current is None:
+					current = self.handle._new_page_meta(uncompPos)
+				if encodedData is None:
+					self.handle._drop_page(current)
+				else:
+					current['method'] = meta['method']
+					self.handle._place_encoded_page(current, plain, encodedData)
+				self._set_changed(uncompPos, False)
+				self.diskWrites += 1
+				self.stats.count('writebackPages')
+			self._writebackCond.notify_all()
+		return True
+
+	def _encode_dirty_page(self, meta, plain):
+		#Pages of zeros are dropped rather than stored
+		if self.handle._is_zero(plain):
+			return None
+		return self.handle._encode_page(meta, plain)
+
+	def _throttle_writer(self):
+
+		#Wake the writeback thread, then wait while there is too much dirty data
+		if self._writebackThread is None:
+			return
+		if self.dirtyBytes > self.dirtyLowBytes:
+			self._writebackCond.notify_all()
+		if self.dirtyBytes > self.dirtyHighBytes:
+			self.stats.count('writerThrottled')
+		while self.dirtyBytes > self.dirtyHighBytes:
+			if self._writebackError is not None:
+				raise self._writebackError[0], self._writebackError[1], self._writebackError[2]
+			self._writebackCond.wait(1.0)
+
+	def _touch_page(self, uncompPos):
+		#Move page to the most recently used end
+		self.pagesPlain[uncompPos] = self.pagesPlain.pop(uncompPos)
+
+	def _add_pages_to_cache(self):
+
+		#Get local copy of cached pages
+		for cp, cm in zip(self.handle._pageCache, self.handle._metaCache):
+			uncompPos = cm['uncompPos']
+			if uncompPos in self.pagesPlain:
+				self.cacheBytes -= len(self.pagesPlain.pop(uncompPos))
+			self.pagesPlain[uncompPos] = bytearray(cp)
+			self._set_changed(uncompPos, False)
+			self.cacheBytes += len(cp)
+
+		#Clear old cached pages if there are too many
+		if self.cacheBytes > self.maxCacheBytes:
+			self._flush_old_pages()
 
 	def _write_to_cache(self, data, expectedPageStart, localCursor):
 
@@ -523,8 +2592,8 @@ class CompressedFile(object):
 		page[localCursor:localCursor+fragmentLen] = data[:fragmentLen]
 		data = data[fragmentLen:]
 		self.virtualCursor += fragmentLen
-		self.pagesChanged[expectedPageStart] = True
-		self.pagesLastUsed[expectedPageStart] = time.time()
+		self._set_changed(expectedPageStart, True)
+		self._touch_page(expectedPageStart)
 
 		if self.virtualCursor > self.handle.plainLen:
 			self.handle.plainLen = self.virtualCursor
@@ -543,47 +2612,204 @@ class CompressedFile(object):
 		self.handle.seek(self.virtualCursor)
 		self.virtualCursor += len(writeFragment)
 		self.handle.write(writeFragment)
-
-		#Get local copy of cached pages
-		for cp, cm in zip(self.handle._pageCache, self.handle._metaCache):
-			uncompPos = cm['uncompPos']
-			self.pagesPlain[uncompPos] = bytearray(cp)
-			self.pagesChanged[uncompPos] = False
-			self.pagesLastUsed[uncompPos] = time.time()
-
-		#Clear old cached pages if there are too many
-		if len(self.pagesPlain) > self.maxCachePages:
-			self._flush_old_pages()
+		self._add_pages_to_cache()
 
 		self.diskWrites += 1
 
 		return data #Return unwritten data
 
+	@_synchronised
 	def write(self, data):
 
 		if self.handle.readOnly:
 			raise Exception("Compressed file is in read only mode")
 
+		startTime = time.time()
 		while len(data) > 0:
 			expectedPageStart = self.virtualCursor - (self.virtualCursor % self.handle.pageStep)
 			expectedPageEnd = expectedPageStart + self.handle.pageStep
 			localCursor = self.virtualCursor - expectedPageStart
 
+			if expectedPageStart in self._readaheadPending:
+				del self._readaheadPending[expectedPageStart]
+
+			if self.streaming and expectedPageStart not in self.pagesPlain and expectedPageStart not in self.handle.pageIndex:
+				#Start a new page in memory
+				self._insert_page(expectedPageStart, bytearray(self.handle.pageStep), True)
+
 			if expectedPageStart in self.pagesPlain:
 				data = self._write_to_cache(data, expectedPageStart, localCursor)
+				if self.streaming and self.virtualCursor == expectedPageEnd:
+					self._stream_page_full(expectedPageStart)
 			else:
 				data = self._write_to_file(data, expectedPageStart, localCursor)
+		self._throttle_writer()
+		self.stats.record_latency("write", time.time() - startTime)
+
+	def _stream_page_full(self, uncompPos):
+
+		#Compress full pages in batches, one page per compression thread
+		if uncompPos in self._streamFull:
+			return
+		self._streamFull.append(uncompPos)
+		if len(self._streamFull) < self.compressThreads:
+			return
+		pages = [(pos, self.pagesPlain[pos]) for pos in self._streamFull if self.pagesChanged.get(pos)]
+		self._streamFull = []
+		self._write_pages(pages)
+		self.diskWrites += len(pages)
+		for pos, page in pages:
+			self._set_changed(pos, False)
+
+	def _update_readahead(self, readStart):
+
+		if self.readaheadMax <= 0:
+			return
+
+		#Grow the window while reads are sequential, drop it on random access
+		if readStart == self._lastReadEnd:
+			self.readaheadWindow = min(max(self.readaheadWindow * 2, 1), self.readaheadMax)
+		else:
+			self.readaheadWindow = 0
+			self._readaheadPending = {}
+		self._lastReadEnd = self.virtualCursor
+
+		if self.readaheadWindow == 0:
+			return
+		if self._readaheadPool is None:
+			self._readaheadPool = WorkerPool(1)
+			self._readaheadFile = self._open_readahead_file()
+
+		#Compressed data is read and decompressed in the background. Buffered
+		#writes are flushed first, since the worker reads the file directly.
+		pageStep = self.handle.pageStep
+		pageStart = self.virtualCursor - (self.virtualCursor % pageStep)
+		flushed = self.handle.readOnly
+		for i in range(self.readaheadWindow):
+			uncompPos = pageStart + i * pageStep
+			if uncompPos >= len(self.handle):
+				break
+			if uncompPos in self.pagesPlain or uncompPos in self._readaheadPending:
+				continue
+			meta = self.handle._get_page_for_index(uncompPos)
+			if meta is None:
+				continue
+			if not flushed:
+				self.handle.handle.flush()
+				flushed = True
+			#The worker uses a copy, since the record may be moved meanwhile
+			meta = dict(meta)
+			if self._readaheadFile:
+				result = self._readaheadPool.submit(self._readahead_page, meta)
+			else:
+				result = self._readaheadPool.submit(self.handle._decode_page, meta, self.handle._read_page_data(meta))
+			self._readaheadPending[uncompPos] = (meta, result)
+
+	def _open_readahead_file(self):
+
+		#The worker reads through its own unbuffered file object, so it does
+		#not move the position of the shared one. Without one, compressed data
+		#is read by the caller and only decompressed in the background.
+		try:
+			fi = open(self.handle.handle.name, "rb", 0)
+			ours = os.fstat(self.handle.handle.fileno())
+		except (AttributeError, TypeError, IOError, OSError):
+			return False
+		theirs = os.fstat(fi.fileno())
+		if (ours.st_dev, ours.st_ino) != (theirs.st_dev, theirs.st_ino):
+			fi.close()
+			return False
+		return fi
+
+	def _readahead_page(self, meta):
+		self._readaheadFile.seek(meta['pagePos'] + self.handle.headerStruct.size + 8)
+		return self.handle._decode_page(meta, self._readaheadFile.read(meta['compSize']))
+
+	def _collect_readahead(self, uncompPos):
+
+		#Move a page decompressed in the background into the page cache
+		pending = self._readaheadPending.pop(uncompPos, None)
+		if pending is None:
+			return False
+
+		#If the record has moved since it was read, it is read again instead
+		meta, result = pending
+		current = self.handle._get_page_for_index(uncompPos)
+		if current is None or [current[key] for key in ('pagePos', 'compSize', 'method')] != \
+			[meta[key] for key in ('pagePos', 'compSize', 'method')]:
+			return False
+		try:
+			plain = result.result()
+		except Exception:
+			return False
+		self.pagesPlain[uncompPos] = bytearray(plain)
+		self._set_changed(uncompPos, False)
+		self.cacheBytes += len(plain)
+		if self.cacheBytes > self.maxCacheBytes:
+			self._flush_old_pages()
+		return uncompPos in self.pagesPlain
 
+	def _read_large(self, bytes):
+
+		#Work out every page in the range, then decompress those not cached in parallel
+		pageStep = self.handle.pageStep
+		start = self.virtualCursor
+		end = min(start + bytes, len(self.handle))
+		if end <= start:
+			return ""
+		if self._decompressPool is None:
+			self._decompressPool = WorkerPool(self.decompressThreads)
+
+		pageStarts = range(start - (start % pageStep), end, pageStep)
+		batchSize = self.decompressThreads * 4
+		outBuffer = []
+		for batchStart in range(0, len(pageStarts), batchSize):
+			batch = pageStarts[batchStart:batchStart+batchSize]
+			toRead = []
+			for uncompPos in batch:
+				if uncompPos in self.pagesPlain:
+					continue
+				meta = self.handle._get_page_for_index(uncompPos)
+				if meta is not None:
+					toRead.append(meta)
+			plains = dict(zip([meta['uncompPos'] for meta in toRead], self.handle.read_pages(toRead, self._decompressPool)))
+			self.diskReads += len(toRead)
+
+			for uncompPos in batch:
+				pageStart = max(start, uncompPos) - uncompPos
+				pageEnd = min(end, uncompPos + pageStep) - uncompPos
+				if uncompPos in self.pagesPlain:
+					outBuffer.append(str(self.pagesPlain[uncompPos][pageStart:pageEnd]))
+					self.cacheReads += 1
+				elif uncompPos in plains:
+					outBuffer.append(plains[uncompPos][pageStart:pageEnd])
+				else:
+					outBuffer.append(self.handle._zero_bytes(pageEnd - pageStart))
+
+		self.virtualCursor = end
+		return "".join(outBuffer)
+
+	@_synchronised
 	def read(self, bytes=None):
 
 		outBuffer = []
 		outBufferLen = 0
+		readStart = self.virtualCursor
+		startTime = time.time()
 		if bytes == None:
 			bytes = len(self.handle) - self.virtualCursor
 
+		if self.decompressThreads > 1 and bytes >= self.largeReadPages * self.handle.pageStep:
+			ret = self._read_large(bytes)
+			self.stats.record_latency("read", time.time() - startTime)
+			return ret
+
 		while outBufferLen < bytes:
 			expectedPageStart = self.virtualCursor - (self.virtualCursor % self.handle.pageStep)
 
+			if expectedPageStart in self._readaheadPending and expectedPageStart not in self.pagesPlain:
+				self._collect_readahead(expectedPageStart)
+
 			if expectedPageStart in self.pagesPlain:
 				#Read from cache
 				page = self.pagesPlain[expectedPageStart]
@@ -598,24 +2824,17 @@ class CompressedFile(object):
 				if bytesStillNeeded > bytesRemainInFile:
 					bytesStillNeeded = bytesRemainInFile
 
-				ret = str(page[localCursor:localCursor+bytesStillNeeded])
+				ret = memoryview(page)[localCursor:localCursor+bytesStillNeeded].tobytes()
+				self._touch_page(expectedPageStart)
 				self.cacheReads +=1
 
 			else:
-				#Read from underlying file
+				#Read from underlying file, up to the end of this page, so a
+				#following page that is only in the cache is not read as a hole
+				localCursor = self.virtualCursor - expectedPageStart
 				self.handle.seek(self.virtualCursor)
-				ret = self.handle.read(bytes - outBufferLen)
-
-				#Get local copy of cached pages
-				for cp, cm in zip(self.handle._pageCache, self.handle._metaCache):
-					uncompPos = cm['uncompPos']
-					self.pagesPlain[uncompPos] = bytearray(cp)
-					self.pagesChanged[uncompPos] = False
-					self.pagesLastUsed[uncompPos] = time.time()
-
-				#Clear old cached pages if there are too many
-				if len(self.pagesPlain) > self.maxCachePages:
-					self._flush_old_pages()
+				ret = self.handle.read(min(bytes - outBufferLen, self.handle.pageStep - localCursor))
+				self._add_pages_to_cache()
 
 				self.diskReads += 1
 
@@ -626,9 +2845,266 @@ class CompressedFile(object):
 				outBuffer.append(ret)
 				outBufferLen += len(ret)
 
+		self._update_readahead(readStart)
+		self.stats.record_latency("read", time.time() - startTime)
+
 		#Concatenation optimisation: http://www.skymind.com/~ocrow/python_string/
 		return "".join(outBuffer)
 
+	def _load_page(self, pageStart):
+
+		#Get a page into the cache, or None if the page is a hole
+		if pageStart in self._readaheadPending and pageStart not in self.pagesPlain:
+			self._collect_readahead(pageStart)
+		if pageStart in self.pagesPlain:
+			self._touch_page(pageStart)
+			self.cacheReads += 1
+			return self.pagesPlain[pageStart]
+
+		meta = self.handle._get_page_for_index(pageStart)
+		if meta is None:
+			return None
+		page = bytearray(self.handle._read_entire_page(meta))
+		self.diskReads += 1
+		self._insert_page(pageStart, page)
+		return page
+
+	def _insert_page(self, uncompPos, page, changed=False):
+
+		#Add a page to the cache, then trim the cache to its budget
+		if uncompPos in self.pagesPlain:
+			self.cacheBytes -= len(self.pagesPlain.pop(uncompPos))
+		self.pagesPlain[uncompPos] = page
+		self._set_changed(uncompPos, changed)
+		self.cacheBytes += len(page)
+		if self.cacheBytes > self.maxCacheBytes:
+			self._flush_old_pages()
+
+	def _page_fragments(self, offset, length):
+
+		#Split a byte range into (pageStart, start, end) parts, with start and end within the page
+		pageStep = self.handle.pageStep
+		pos = offset
+		end = offset + length
+		while pos < end:
+			pageStart = pos - (pos % pageStep)
+			fragmentEnd = min(end, pageStart + pageStep)
+			yield pageStart, pos - pageStart, fragmentEnd - pageStart
+			pos = fragmentEnd
+
+	def _read_pages_for_batch(self, metas):
+
+		#Read pages in on disk order, decompressing in parallel if there are threads
+		pool = None
+		if self.decompressThreads > 1 and len(metas) > 1:
+			if self._decompressPool is None:
+				self._decompressPool = WorkerPool(self.decompressThreads)
+			pool = self._decompressPool
+		plains = self.handle.read_pages(metas, pool)
+		self.diskReads += len(metas)
+		return dict(zip([meta['uncompPos'] for meta in metas], plains))
+
+	@_synchronised
+	def readv(self, requests):
+		"""
+		Read a list of (offset, length) ranges, returning a string for each in
+		request order. Each page is read and decompressed at most once, in on
+		disk order. The cursor is not moved.
+		"""
+		startTime = time.time()
+		fileLen = len(self.handle)
+		ranges = []
+		for offset, length in requests:
+			if offset < 0 or length < 0:
+				raise IOError("Invalid argument")
+			ranges.append(list(self._page_fragments(offset, max(min(length, fileLen - offset), 0))))
+
+		#Find the pages that must come from disk
+		pages = {}
+		toRead = []
+		for pageStart in sorted(set([fragment[0] for fragments in ranges for fragment in fragments])):
+			if pageStart in self._readaheadPending and pageStart not in self.pagesPlain:
+				self._collect_readahead(pageStart)
+			if pageStart in self.pagesPlain:
+				pages[pageStart] = self.pagesPlain[pageStart]
+				self._touch_page(pageStart)
+				self.cacheReads += 1
+				continue
+			meta = self.handle._get_page_for_index(pageStart)
+			if meta is not None:
+				toRead.append(meta)
+
+		for uncompPos, plain in self._read_pages_for_batch(toRead).iteritems():
+			pages[uncompPos] = bytearray(plain)
+			self._insert_page(uncompPos, pages[uncompPos])
+
+		out = []
+		for fragments in ranges:
+			outBuffer = []
+			for pageStart, start, end in fragments:
+				page = pages.get(pageStart)
+				inPage = 0
+				if page is not None:
+					inPage = max(min(end, len(page)) - start, 0)
+					outBuffer.append(memoryview(page)[start:start+inPage].tobytes())
+				if inPage < end - start:
+					outBuffer.append(self.handle._zero_bytes(end - start - inPage))
+			out.append("".join(outBuffer))
+		self.stats.record_latency("readv", time.time() - startTime)
+		return out
+
+	@_synchronised
+	def writev(self, requests):
+		"""
+		Write a list of (offset, data) pairs, applied in request order.
+		Each page is decompressed, modified and compressed at most once.
+		Cached pages are changed in the cache, other pages are written to the
+		file together. The cursor is not moved.
+		"""
+		if self.handle.readOnly:
+			raise Exception("Compressed file is in read only mode")
+
+		startTime = time.time()
+		pageStep = self.handle.pageStep
+		byPage = {}
+		newLen = self.handle.plainLen
+		for offset, data in requests:
+			if offset < 0:
+				raise IOError("Invalid argument")
+			for pageStart, start, end in self._page_fragments(offset, len(data)):
+				dataStart = pageStart + start - offset
+				byPage.setdefault(pageStart, []).append((start, data[dataStart:dataStart + end - start]))
+			#Like a file, an empty write does not extend it
+			if len(data) > 0:
+				newLen = max(newLen, offset + len(data))
+
+		toRead = []
+		toWrite = []
+		for pageStart in sorted(byPage):
+			if pageStart in self._readaheadPending:
+				del self._readaheadPending[pageStart]
+			if pageStart in self.pagesPlain:
+				page = self.pagesPlain[pageStart]
+				for start, fragment in byPage[pageStart]:
+					page[start:start+len(fragment)] = fragment
+				self._set_changed(pageStart, True)
+				self._touch_page(pageStart)
+				self.cacheWrites += 1
+				continue
+
+			#Pages that are entirely overwritten do not need decompressing
+			meta = self.handle._get_page_for_index(pageStart)
+			whole = [1 for start, fragment in byPage[pageStart] if start == 0 and len(fragment) == pageStep]
+			if meta is not None and len(whole) == 0:
+				toRead.append(meta)
+			toWrite.append(pageStart)
+
+		plains = self._read_pages_for_batch(toRead)
+		pages = []
+		for pageStart in toWrite:
+			if pageStart in plains:
+				page = bytearray(plains[pageStart])
+			else:
+				page = bytearray(pageStep)
+			for start, fragment in byPage[pageStart]:
+				page[start:start+len(fragment)] = fragment
+			pages.append((pageStart, page))
+
+		self.handle.plainLen = newLen
+		self._write_pages(pages)
+		self.diskWrites += len(pages)
+		for pageStart, page in pages:
+			self._insert_page(pageStart, page)
+		self._throttle_writer()
+		self.stats.record_latency("writev", time.time() - startTime)
+
+	def _readinto_direct(self, pageStart, localCursor, view):
+
+		#Uncompressed pages that are not cached skip the cache entirely
+		if pageStart in self.pagesPlain or pageStart in self._readaheadPending:
+			return False
+		meta = self.handle._get_page_for_index(pageStart)
+		if meta is None or meta['method'] != "null" or pageStart in self.handle.overlay:
+			return False
+		self.handle._readinto_page(meta, localCursor, view)
+		self.diskReads += 1
+		return True
+
+	@_synchronised
+	def readinto(self, buffer):
+		"""
+		Read into a writable buffer, such as a bytearray, and return the number
+		of bytes read. Data is copied from the cached pages without building
+		intermediate strings.
+		"""
+		view = memoryview(buffer)
+		readStart = self.virtualCursor
+		startTime = time.time()
+		pageStep = self.handle.pageStep
+		total = min(len(view), max(len(self.handle) - self.virtualCursor, 0))
+		done = 0
+
+		while done < total:
+			pageStart = self.virtualCursor - (self.virtualCursor % pageStep)
+			localCursor = self.virtualCursor - pageStart
+			count = min(total - done, pageStep - localCursor)
+			target = view[done:done+count]
+
+			if not self._readinto_direct(pageStart, localCursor, target):
+				page = self._load_page(pageStart)
+				if page is None:
+					target[:] = self.handle._zero_bytes(count)
+				else:
+					inPage = min(count, max(len(page) - localCursor, 0))
+					target[:inPage] = memoryview(page)[localCursor:localCursor+inPage]
+					if inPage < count:
+						target[inPage:] = self.handle._zero_bytes(count - inPage)
+
+			self.virtualCursor += count
+			done += count
+
+		self._update_readahead(readStart)
+		self.stats.record_latency("readinto", time.time() - startTime)
+		return done
+
+	@_synchronised
+	def read_view(self, bytes):
+		"""
+		Return a memoryview of up to bytes at the cursor without copying.
+		The view covers one page at most, so it may be shorter than asked for.
+		It shares memory with the page cache, so it must not be modified and
+		it sees later writes to the page.
+		"""
+		readStart = self.virtualCursor
+		pageStep = self.handle.pageStep
+		bytes = min(bytes, len(self.handle) - self.virtualCursor)
+		if bytes <= 0:
+			return memoryview("")
+
+		pageStart = self.virtualCursor - (self.virtualCursor % pageStep)
+		localCursor = self.virtualCursor - pageStart
+		count = min(bytes, pageStep - localCursor)
+
+		if pageStart not in self.pagesPlain and pageStart not in self._readaheadPending:
+			meta = self.handle._get_page_for_index(pageStart)
+			mapped = None if meta is None else self.handle.page_view(meta)
+			if mapped is not None and localCursor < len(mapped):
+				count = min(count, len(mapped) - localCursor)
+				self.virtualCursor += count
+				self._update_readahead(readStart)
+				return mapped[localCursor:localCursor+count]
+
+		page = self._load_page(pageStart)
+		if page is None or localCursor >= len(page):
+			view = memoryview(self.handle.zeroPage)[:count]
+		else:
+			count = min(count, len(page) - localCursor)
+			view = memoryview(page)[localCursor:localCursor+count]
+
+		self.virtualCursor += count
+		self._update_readahead(readStart)
+		return view
+
 	def tell(self):
 		return self.virtualCursor
 
@@ -651,9 +3127,274 @@ class CompressedFile(object):
 			self.virtualCursor = self.handle.plainLen + pos
 			return
 
+	def _cached_only_pages(self):
+		#Pages in memory that are not yet stored in the file
+		return sorted([uncompPos for uncompPos in self.pagesPlain if uncompPos not in self.handle.pageIndex])
+
+	def iter_extents(self):
+		"""
+		Yield (start, length) for each range of the file that holds data,
+		either in the file or in the page cache. Other ranges read as zeros.
+		"""
+		pageStarts = heapq.merge(self.handle.pageIndex.sorted_keys(), self._cached_only_pages())
+		return _merge_extents(pageStarts, self.handle.pageStep, len(self))
+
+	def _has_page(self, uncompPos):
+		return uncompPos in self.pagesPlain or uncompPos in self.handle.pageIndex
+
+	def _next_data_page(self, pageStart):
+		candidates = [_next_page_start(self.handle.pageIndex.sorted_keys(), pageStart),
+			_next_page_start(self._cached_only_pages(), pageStart)]
+		candidates = [uncompPos for uncompPos in candidates if uncompPos is not None]
+		if len(candidates) == 0:
+			return None
+		return min(candidates)
+
+	@_synchronised
+	def seek_data(self, pos):
+		#Move to the first data at or after pos, like lseek with SEEK_DATA
+		self.virtualCursor = _seek_data(self, pos, self.handle.pageStep)
+		return self.virtualCursor
+
+	@_synchronised
+	def seek_hole(self, pos):
+		#Move to the first hole at or after pos, like lseek with SEEK_HOLE
+		self.virtualCursor = _seek_hole(self, pos, self.handle.pageStep)
+		return self.virtualCursor
+
+	def __len__(self):
+		return len(self.handle)
+
+# ****************************************************************************
+
+class ConcurrentCompressedFile(object):
+
+	"""
+	Read only access to a compressed file that may be shared between threads
+	There is no cursor: pread reads at a given offset. Decompressed pages are
+	kept in a cache split into stripes, each with its own lock, so threads
+	working on different pages rarely wait for each other and decompression
+	runs outside the locks. Changes made through other handles after opening
+	are not seen.
+	"""
+
+	def __init__(self, handle, maxCacheBytes = 50000000, cacheStripes = 16):
+
+		if isinstance(handle, CompressedFileLowLevel):
+			self.handle = handle
+		else:
+			self.handle = CompressedFileLowLevel(handle, readOnly=True)
+
+		self.maxStripeBytes = maxCacheBytes // cacheStripes
+		self._stripeLocks = [threading.Lock() for i in range(cacheStripes)]
+		self._stripePages = [collections.OrderedDict() for i in range(cacheStripes)]
+		self._stripeBytes = [0] * cacheStripes
+		self._stripeHits = [0] * cacheStripes
+		self._stripeMisses = [0] * cacheStripes
+
+	def cache_stats(self):
+		#Hit and miss counts for the page cache
+		return {'pageCacheHits': sum(self._stripeHits), 'pageCacheMisses': sum(self._stripeMisses),
+			'pageCacheBytes': sum(self._stripeBytes)}
+
+	def _get_page(self, uncompPos):
+
+		#Return a decompressed page, or None for a hole
+		stripe = (uncompPos // self.handle.pageStep) % len(self._stripeLocks)
+		pages = self._stripePages[stripe]
+		with self._stripeLocks[stripe]:
+			page = pages.pop(uncompPos, None)
+			if page is not None:
+				pages[uncompPos] = page
+				self._stripeHits[stripe] += 1
+				return page
+			self._stripeMisses[stripe] += 1
+
+		meta = self.handle.pageIndex.get(uncompPos)
+		if meta is None:
+			return None
+		page = self.handle._decode_page(meta, self.handle._pread_page_data(meta))
+
+		with self._stripeLocks[stripe]:
+			if uncompPos not in pages:
+				pages[uncompPos] = page
+				self._stripeBytes[stripe] += len(page)
+			while self._stripeBytes[stripe] > self.maxStripeBytes and len(pages) > 0:
+				self._stripeBytes[stripe] -= len(pages.popitem(last=False)[1])
+		return page
+
+	def pread(self, offset, bytes):
+		"""
+		Read up to bytes starting at offset. Safe to call from several threads.
+		"""
+		if offset < 0:
+			raise IOError("Invalid argument")
+		pageStep = self.handle.pageStep
+		end = min(offset + bytes, len(self.handle))
+		outBuffer = []
+		pos = offset
+		while pos < end:
+			pageStart = pos - (pos % pageStep)
+			fragmentEnd = min(end, pageStart + pageStep)
+			page = self._get_page(pageStart)
+			if page is None or pos - pageStart >= len(page):
+				outBuffer.append(self.handle._zero_bytes(fragmentEnd - pos))
+			else:
+				fragment = page[pos - pageStart:fragmentEnd - pageStart]
+				outBuffer.append(fragment)
+				if len(fragment) < fragmentEnd - pos:
+					outBuffer.append(self.handle._zero_bytes(fragmentEnd - pos - len(fragment)))
+			pos = fragmentEnd
+		return "".join(outBuffer)
+
 	def __len__(self):
 		return len(self.handle)
 
+# ****************************************************************************
+
+class AsyncCompressedFile(object):
+
+	"""
+	Non blocking front end to a CompressedFile
+	Every call returns a PendingResult straight away. Requests are carried out
+	in the order they were made by a dispatcher thread, which keeps its own cursor.
+	Reads, or writes, that are queued back to back are served as one readv or
+	writev, so their pages are decompressed or compressed together by the
+	worker threads of the file (see compressThreads and decompressThreads).
+	At most maxPending requests are queued, after which calls block.
+	There is one dispatcher thread, so requests are carried out one batch at a
+	time. A seek, tell or flush between reads ends the batch, and requests on
+	different pages then wait for each other rather than running at once.
+	Use add_done_callback on the results to be told when a request completes.
+	"""
+
+	def __init__(self, handle, maxPending = 64, **args):
+
+		if isinstance(handle, CompressedFile):
+			self.cfile = handle
+		else:
+			self.cfile = CompressedFile(handle, **args)
+
+		self._requests = Queue.Queue(maxPending)
+		self._thread = threading.Thread(target=_dispatch_loop, args=(self.cfile, self._requests))
+		self._thread.daemon = True
+		self._thread.start()
+
+	def _submit(self, op, *args):
+		if self._thread is None:
+			raise IOError("File is closed")
+		result = PendingResult()
+		self._requests.put((result, op, args))
+		return result
+
+	def read(self, bytes = None):
+		return self._submit("read", bytes)
+
+	def write(self, data):
+		return self._submit("write", data)
+
+	def seek(self, pos, mode = 0):
+		return self._submit("seek", pos, mode)
+
+	def tell(self):
+		return self._submit("tell")
+
+	def flush(self):
+		return self._submit("flush")
+
+	def readv(self, requests):
+		return self._submit("readv", requests)
+
+	def writev(self, requests):
+		return self._submit("writev", requests)
+
+	def close(self):
+
+		#Wait for outstanding requests, then write cached pages to disk
+		if self._thread is None:
+			return
+		result = self.flush()
+		self._requests.put(None)
+		thread, self._thread = self._thread, None
+		if thread is threading.current_thread():
+			#Closed from a callback, the dispatcher finishes the queue as it exits
+			return
+		thread.join()
+		result.result()
+
+	def __del__(self):
+		self.close()
+
+def _dispatch_loop(cfile, requests):
+	#Holds the CompressedFile but not the AsyncCompressedFile, so dropping that closes it
+	cursor = 0
+	held = []
+	while True:
+		job = held.pop() if held else requests.get()
+		if job is None:
+			return
+
+		#Gather reads or writes that are already queued behind this one
+		run = [job]
+		while job[1] in ("read", "write"):
+			try:
+				nextJob = requests.get_nowait()
+			except Queue.Empty:
+				break
+			if nextJob is not None and nextJob[1] == job[1]:
+				run.append(nextJob)
+			else:
+				held.append(nextJob)
+				break
+
+		try:
+			values, cursor = _dispatch_run(cfile, cursor, job[1], run)
+		except Exception:
+			excInfo = sys.exc_info()
+			for result, op, args in run:
+				result._set(None, excInfo)
+			continue
+		for (result, op, args), value in zip(run, values):
+			result._set(value, None)
+
+def _dispatch_run(cfile, cursor, op, run):
+
+	#Carry out a run of requests, returning their values and the new cursor
+	if op == "read":
+		fileLen = len(cfile)
+		requests = []
+		for result, op, args in run:
+			bytes = args[0]
+			if bytes is None:
+				bytes = fileLen
+			bytes = max(min(bytes, fileLen - cursor), 0)
+			requests.append((cursor, bytes))
+			cursor += bytes
+		return cfile.readv(requests), cursor
+
+	if op == "write":
+		requests = []
+		for result, op, args in run:
+			requests.append((cursor, args[0]))
+			cursor += len(args[0])
+		cfile.writev(requests)
+		return [None] * len(run), cursor
+
+	args = run[0][2]
+	if op == "seek":
+		cfile.virtualCursor = cursor
+		cfile.seek(*args)
+		return [cfile.virtualCursor], cfile.virtualCursor
+	if op == "tell":
+		return [cursor], cursor
+	if op == "flush":
+		return [cfile.flush()], cursor
+	if op == "readv":
+		return [cfile.readv(*args)], cursor
+	if op == "writev":
+		return [cfile.writev(*args)], cursor
+	raise ValueError("Unknown request " + op)
+
 def IntegrityTest():
 	"""
 	Do random writes to a compressed file and a normal file
@@ -704,6 +3445,116 @@ def IntegrityTest():
 		if len(test1) == 0:
 			break
 
+def CachedPageTest():
+	"""
+	Check that a page held only in the cache is read correctly by a read
+	that starts in a hole before it
+	"""
+
+	try:
+		os.unlink("test.pages")
+	except:
+		pass
+
+	#A flush drops the page once it is all zeros, then it is written again in the cache
+	pf = CompressedFile("test.pages", createFile=True, pageStep=4096)
+	pf.seek(8192)
+	pf.write("A"*10)
+	pf.seek(8192)
+	pf.write("\x00"*10)
+	pf.flush()
+	pf.seek(8192)
+	pf.write("B"*10)
+	pf.seek(0)
+	test = pf.read(8202)[8192:]
+	del pf
+	os.unlink("test.pages")
+	if test != "B"*10:
+		print "Cached page read error", repr(test)
+		return 0
+	print "Cached page read ok"
+	return 1
+
+def StreamingReadTest(seed = 0):
+	"""
+	Do random writes and reads in streaming mode and compare them with
+	the same operations on a string
+	"""
+
+	try:
+		os.unlink("test.pages")
+	except:
+		pass
+
+	rnd = random.Random(seed)
+	pf = CompressedFile("test.pages", createFile=True, pageStep=4096, maxCacheBytes=40000, streaming=True)
+	ref = bytearray()
+	ok = 1
+	for i in range(2000):
+		pos = rnd.randint(0, 200000)
+		if rnd.random() < 0.7:
+			data = chr(rnd.randint(97, 122)) * rnd.randint(1, 10000)
+			pf.seek(pos)
+			pf.write(data)
+			if len(ref) < pos:
+				ref.extend("\x00" * (pos - len(ref)))
+			ref[pos:pos+len(data)] = data
+		else:
+			size = rnd.randint(1, 20000)
+			pf.seek(pos)
+			if pf.read(size) != str(ref[pos:pos+size]):
+				print "Streaming read error", i, pos, size
+				ok = 0
+				break
+	if ok:
+		pf.flush()
+		pf.seek(0)
+		if pf.read() != str(ref):
+			print "Streaming file error"
+			ok = 0
+	del pf
+	os.unlink("test.pages")
+	if ok:
+		print "Streaming reads ok"
+	return ok
+
+def StreamingRewriteTest():
+	"""
+	Rewrite a full page in streaming mode with several compression threads,
+	then compact and check the data survives
+	"""
+
+	ok = 1
+	for dedup in [False, True]:
+		try:
+			os.unlink("test.pages")
+		except:
+			pass
+
+		pf = CompressedFile("test.pages", createFile=True, pageStep=4096, streaming=True, compressThreads=2, dedup=dedup)
+		pf.write("A" * 4096)
+		pf.seek(0)
+		pf.write("B" * 4096)
+		pf.seek(8192)
+		pf.write("C" * 4096)
+		pf.compact()
+		expected = "B" * 4096 + "\x00" * 4096 + "C" * 4096
+		pf.seek(0)
+		if pf.read() != expected:
+			print "Streaming rewrite error", dedup
+			ok = 0
+		del pf
+
+		pf = CompressedFile("test.pages")
+		if pf.read() != expected:
+			print "Streaming rewrite reopen error", dedup
+			ok = 0
+		del pf
+	os.unlink("test.pages")
+	if ok:
+		print "Streaming rewrite ok"
+	return ok
+
 if __name__ == "__main__":
 
 	if 0:
@@ -742,6 +3593,9 @@ if __name__ == "__main__":
 		pf.handle._refresh_page_index()
 
 	if 1:
+		CachedPageTest()
+		StreamingReadTest()
+		StreamingRewriteTest()
 		IntegrityTest()
 		
 
@@ -16,7 +16,7 @@ if __name__ == "__main__":
 		pass
 
 	infi = bz2.BZ2File(sys.argv[1])
-	outfi = compressedfile.CompressedFile(sys.argv[2])
+	outfi = compressedfile.CompressedFile(sys.argv[2], createFile=True, streaming=True)
 
 	while True:
 		data = infi.read(1000000)
@@ -0,0 +1,32 @@
+import compressedfile, sys, os, time
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print "Specify compressed file as argument"
+		exit(1)
+
+	#Optionally move at most stepBytes at a time, pausing between steps
+	stepBytes = None
+	if len(sys.argv) >= 3:
+		stepBytes = int(sys.argv[2])
+	pause = 0.0
+	if len(sys.argv) >= 4:
+		pause = float(sys.argv[3])
+
+	sizeBefore = os.path.getsize(sys.argv[1])
+	fi = compressedfile.CompressedFileLowLevel(sys.argv[1])
+	if fi.readOnly:
+		print "File cannot be opened for writing"
+		exit(1)
+
+	#The directory is written after every step, so the file can be used or left between steps
+	steps = 1
+	while not fi.compact(stepBytes):
+		fi.flush()
+		steps += 1
+		time.sleep(pause)
+	fi.flush()
+	del fi
+
+	print "Compacted in", steps, "steps from", sizeBefore, "to", os.path.getsize(sys.argv[1]), "bytes"
+
@@ -12,15 +12,16 @@ if __name__ == "__main__":
 	infi = compressedfile.CompressedFile(sys.argv[1])
 	outfi = open(sys.argv[2], "w+b")
 
-	try:
-		os.unlink(sys.argv[2])
-	except:
-		pass
-
-	while True:
-		data = infi.read(100000)
-		if len(data) == 0: break
-		outfi.write(data)
+	#Only copy ranges that hold data, so holes stay sparse in the output
+	for extentStart, extentLen in infi.iter_extents():
+		infi.seek(extentStart)
+		outfi.seek(extentStart)
+		while extentLen > 0:
+			data = infi.read(min(extentLen, 100000))
+			if len(data) == 0: break
+			outfi.write(data)
+			extentLen -= len(data)
 
+	outfi.truncate(len(infi))
 	outfi.flush()
 
@@ -0,0 +1,44 @@
+import compressedfile, sys, random
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print "Specify compressed file as argument"
+		exit(1)
+
+	args = [arg for arg in sys.argv[1:] if arg != "--recompress"]
+	recompress = "--recompress" in sys.argv
+	numSamples = 50
+	if len(args) >= 2:
+		numSamples = int(args[1])
+	dictSize = 32768
+	if len(args) >= 3:
+		dictSize = int(args[2])
+	maxSampleLen = 65536
+
+	fi = compressedfile.CompressedFileLowLevel(args[0])
+
+	#Train from a random selection of pages
+	pagePositions = sorted(fi.pageIndex)
+	if len(pagePositions) == 0:
+		print "File has no pages to sample"
+		exit(1)
+	random.seed(0)
+	if len(pagePositions) > numSamples:
+		pagePositions = sorted(random.sample(pagePositions, numSamples))
+	samples = []
+	for uncompPos in pagePositions:
+		page = fi._read_entire_page(fi.pageIndex[uncompPos])
+		start = random.randint(0, max(len(page) - maxSampleLen, 0))
+		samples.append(page[start:start+maxSampleLen])
+
+	dictionary = compressedfile.train_dictionary(samples, dictSize)
+	print "Trained dictionary of", len(dictionary), "bytes from", len(samples), "pages"
+	fi.set_dictionary(dictionary)
+
+	if recompress:
+		#Rewrite zlib pages to use the dictionary
+		fi.recompress("zdct", fromMethod = "zlib")
+		print "Recompressed zlib pages"
+
+	fi.flush()
+